@@ -2,16 +2,24 @@
 # pylint: disable=broad-except
 
 import argparse
+import hashlib
+import json
 import logging
+import os
+import subprocess
+import tempfile
 import types
 from distutils.util import strtobool
 import sys
-from typing import List
+from typing import Iterable, List, Optional
 
 from . import hostlist
 from . import cnamelist
-from .output_services import Output_Services
+from .output_services import Output_Services, Output_Classes
 from .config import CONFIGINSTANCE as Config
+from .cache import atomic_open, atomic_write
+from .manifest import Manifest
+from .query import Query
 try:
     from .dnsvs import sync
     from .dnsvs import DNSVSInterface
@@ -39,9 +47,51 @@ def parse_args(services: List[str]) -> argparse.Namespace:
                         '-d',
                         action='store_true',
                         help='only parse, don\'t sync')
+    parser.add_argument('--jobs',
+                        '-j',
+                        type=int,
+                        help='number of processes used to parse the hostlist files,'
+                        ' 0 means one per CPU (default: jobs from config or 1)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='parse all hostlist files, ignoring the parse cache')
+    parser.add_argument('--check-report',
+                        metavar='FILE',
+                        help='write duration, examined hosts and failures of each check as json to FILE')
+    parser.add_argument('--full-check',
+                        action='store_true',
+                        help='check all hosts, not only those of files changed since the last successful check')
+    parser.add_argument('--changed-since',
+                        metavar='REV',
+                        help='only check the hostlist files changed since the git revision REV'
+                        ' against the others, e.g. in a pre-commit hook')
+    parser.add_argument('--staged',
+                        action='store_true',
+                        help='like --changed-since, for the files staged in the git index')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='build the output of a single-pass service (%s) host by host'
+                        ' while parsing, without consistency checks'
+                        % ', '.join(s for s in services if Output_Classes[s].single_pass))
+    parser.add_argument('--all',
+                        action='store_true',
+                        help='run all services, needs --outdir')
+    parser.add_argument('--outdir',
+                        metavar='DIR',
+                        help='write the output of each service to a file named like the service in DIR,'
+                        ' only if it changed')
+    parser.add_argument('--manifest',
+                        action='store_true',
+                        help='with --outdir, also write a manifest of the fingerprints of the entries per host'
+                        ' of the services that have them to DIR/<service>.manifest')
+    parser.add_argument('--delta',
+                        action='store_true',
+                        help='like --manifest, and write the entries added, changed and removed since'
+                        ' the last manifest as json to DIR/<service>.delta')
     parser.add_argument('filter',
                         nargs='*',
-                        help='''Print hosts matching a given filter. This can be hostnames or groupnames.''')
+                        help='''Print hosts matching a given filter. This can be hostnames, groupnames or var=value,
+                        !term excludes hosts. Terms can be combined with AND, OR, NOT and parentheses.''')
 
     for service in services:
         parser.add_argument('--' + service,
@@ -106,19 +156,137 @@ def sync_dnsvs(file_hostlist, file_cnames, dryrun):
             sync.apply_diff(total_diff)
 
 
-def run_service(service: str, file_hostlist: hostlist.Hostlist, file_cnames: cnamelist.CNamelist) -> None:
+def _git(hostlistdir: str, *args: str) -> str:
+    return subprocess.run(('git', '-C', hostlistdir) + args, stdout=subprocess.PIPE,
+                          check=True, universal_newlines=True).stdout
+
+
+def changed_files(hostlistdir: str, rev: Optional[str]=None, staged: bool=False) -> List[str]:
+    """ask git for the hostlist files changed since rev (HEAD) or differing from the index
+
+    returns the file names relative to hostlistdir, including removed files.
+    Renames count as removing the old and adding the new file."""
+
+    if staged:
+        # files with unstaged changes are read from the index, so they count as changed too
+        changed = _git(hostlistdir, 'diff', '--cached', '--name-only', '--no-renames', '--relative', '--', '.')
+        changed += _git(hostlistdir, 'diff', '--name-only', '--no-renames', '--relative', '--', '.')
+    else:
+        changed = _git(hostlistdir, 'diff', '--name-only', '--no-renames', '--relative', rev or 'HEAD', '--', '.')
+    changed += _git(hostlistdir, 'ls-files', '--others', '--exclude-standard', '--', '.')
+    return sorted({f for f in changed.splitlines() if '/' not in f and f.endswith('.yml')})
+
+
+def staged_files(hostlistdir: str, names: Iterable[str], outdir: str) -> List[str]:
+    """write the staged content of the hostlist files names to outdir
+
+    returns the paths of the written files, names not in the index are skipped"""
+
+    indexed = set(_git(hostlistdir, 'ls-files', '--', '.').splitlines())
+    written = []
+    for name in names:
+        if name in indexed:
+            blob = subprocess.run(('git', '-C', hostlistdir, 'show', ':./' + name),
+                                  stdout=subprocess.PIPE, check=True).stdout
+            written.append(os.path.join(outdir, name))
+            with open(written[-1], 'wb') as outfile:
+                outfile.write(blob)
+    return written
+
+
+def check_changes(args: argparse.Namespace, config) -> None:
+    """check only the changed hostlist files against the other ones
+
+    With --staged, the changed files are checked as they are in the index."""
+    with tempfile.TemporaryDirectory() as stagedir:
+        try:
+            changed = changed_files(config.hostlistdir, args.changed_since, args.staged)
+            if args.staged:
+                present = staged_files(config.hostlistdir, changed, stagedir)
+            else:
+                present = [os.path.join(config.hostlistdir, f) for f in changed
+                           if os.path.isfile(os.path.join(config.hostlistdir, f))]
+        except (OSError, subprocess.CalledProcessError) as exc:
+            logging.error("Failed to get changed files from git: %s" % exc)
+            sys.exit(1)
+        removed = set(changed) - {os.path.basename(f) for f in present}
+        file_hostlist = hostlist.YMLHostlist(jobs=args.jobs, use_cache=not args.no_cache, config=config, fnames=present)
+        file_cnames = cnamelist.FileCNamelist(config)
+        file_hostlist.check_changes(file_cnames,
+                                    removed=sorted(removed),
+                                    report=args.check_report,
+                                    use_cache=not args.no_cache)
+
+
+def run_service(service: str, file_hostlist: Iterable, file_cnames: cnamelist.CNamelist) -> None:
     "Run all services according to servicedict on hosts in file_hostlist."
     if service in Output_Services:
         logging.info("generating output for " + service)
-        out = Output_Services[service](file_hostlist, file_cnames)
-        if isinstance(out, str):
-            print(out)
-        else:
-            logging.critical("Service " + service + " did not return a String.")
+        for chunk in Output_Classes[service].iter_content(file_hostlist, file_cnames):
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
     else:
         logging.critical("Service " + service + " not known.")
 
 
+def write_service(service: str, file_hostlist: Iterable, file_cnames: cnamelist.CNamelist, outdir: str,
+                  manifest: bool=False, delta: bool=False) -> bool:
+    """write the output of service to outdir/service
+
+    The file is replaced atomically and left alone if its content is unchanged.
+    With manifest, the fingerprints of the entries of services that have them
+    are written to outdir/service.manifest, with delta also the changes since
+    the last manifest to outdir/service.delta.
+    Returns False if the service failed."""
+
+    logging.info("generating output for " + service)
+    output = Output_Classes[service]
+    fname = os.path.join(outdir, service)
+    record = None
+    if (manifest or delta) and output.has_entries:
+        previous = None
+        if delta:
+            previous = Manifest.load(fname + '.manifest') or Manifest()
+        record = Manifest(previous)
+    try:
+        if record is None:
+            chunks = output.iter_content(file_hostlist, file_cnames)
+        else:
+            chunks = output.content_of(record.record(output.iter_entries(file_hostlist, file_cnames)))
+        digest = hashlib.sha256()
+        with atomic_open(fname, only_changed=True) as outfile:
+            for chunk in chunks:
+                data = chunk.encode('utf8')
+                digest.update(data)
+                outfile.write(data)
+            outfile.write(b'\n')
+            digest.update(b'\n')
+        if record is not None:
+            record.output = digest.hexdigest()
+            if delta:
+                atomic_write(fname + '.delta', json.dumps(record.delta(service), indent=2).encode('utf8'))
+            record.save(fname + '.manifest')
+    except Exception as exc:
+        logging.error("Service %s failed: %s" % (service, exc))
+        return False
+    return True
+
+
+def output_services(activeservices: Iterable[str], file_hostlist: Iterable,
+                    file_cnames: cnamelist.CNamelist, outdir: Optional[str],
+                    manifest: bool=False, delta: bool=False) -> None:
+    "print the output of the active service or write the output of all of them to outdir"
+    if outdir is None:
+        for service in activeservices:
+            run_service(service, file_hostlist, file_cnames)
+        return
+    os.makedirs(outdir, exist_ok=True)
+    results = [write_service(service, file_hostlist, file_cnames, outdir, manifest, delta)
+               for service in sorted(activeservices)]
+    if not all(results):
+        sys.exit(1)
+
+
 def main():
     "main routine"
 
@@ -129,11 +297,14 @@ def main():
 
     # get a dict of the arguments
     argdict = vars(args)
-    activeservices = {s for s in services if argdict[s]}
+    activeservices = {s for s in services if argdict[s] or args.all}
 
     if activeservices:
-        if len(activeservices) > 1:
-            logging.error("Can only output one service at a time.")
+        if len(activeservices) > 1 and not args.outdir:
+            logging.error("Can only output one service at a time, unless --outdir is given.")
+            sys.exit(2)
+        if (args.manifest or args.delta) and not args.outdir:
+            logging.error("--manifest and --delta need --outdir.")
             sys.exit(2)
         args.quiet = True
         args.dryrun = True
@@ -147,20 +318,47 @@ def main():
     if not Config.load():
         logging.error("Need %s file to run." % Config.CONFIGNAME)
         sys.exit(1)
+    config = Config.compiled()
+
+    if args.stream:
+        if len(activeservices) != 1 or not Output_Classes[next(iter(activeservices))].single_pass:
+            logging.error("--stream needs exactly one single-pass service.")
+            sys.exit(2)
+        output_services(activeservices, hostlist.iter_hosts(config=config), cnamelist.FileCNamelist(config),
+                        args.outdir, args.manifest, args.delta)
+        sys.exit(0)
+
+    if args.changed_since or args.staged:
+        if activeservices or args.filter:
+            logging.error("--changed-since and --staged only check, they cannot output services or hosts.")
+            sys.exit(2)
+        check_changes(args, config)
+        sys.exit(0)
+
+    query = None
+    if args.filter:
+        try:
+            query = Query(args.filter)
+        except Exception as e:
+            logging.error("Invalid filter: %s" % e)
+            sys.exit(2)
 
     logging.info("loading hostlist from yml files")
-    file_hostlist = hostlist.YMLHostlist()
+    file_hostlist = hostlist.YMLHostlist(jobs=args.jobs, use_cache=not args.no_cache, config=config)
     logging.info("loading cnames from file")
-    file_cnames = cnamelist.FileCNamelist()
+    file_cnames = cnamelist.FileCNamelist(config)
 
-    file_hostlist.check_consistency(file_cnames)
+    file_hostlist.check_consistency(file_cnames,
+                                    report=args.check_report,
+                                    incremental=True,
+                                    full=args.full_check)
 
-    if args.filter:
-        file_hostlist.print(args.filter)
+    if query is not None:
+        file_hostlist.print(query)
         sys.exit(0)
 
     if activeservices:
-        run_service(activeservices.pop(), file_hostlist, file_cnames)
+        output_services(activeservices, file_hostlist, file_cnames, args.outdir, args.manifest, args.delta)
 
     if not args.dryrun:
         sync_dnsvs(file_hostlist, file_cnames, args.dryrun)
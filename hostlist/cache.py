@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import fcntl
+import hashlib
+import logging
+import pickle
+import tempfile
+import time
+import contextlib
+from typing import Optional
+
+from .config import CompiledConfig
+
+# bump whenever the pickled host objects change their layout
+FORMAT_VERSION = 4
+
+
+@contextlib.contextmanager
+def atomic_open(fname: str, only_changed: bool=False):
+    """open a temporary file for writing, which replaces fname when closed
+
+    So readers never see partial content. With only_changed, fname
+    is left untouched if the new content is the same."""
+
+    dirname = os.path.dirname(fname) or '.'
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(fname) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            yield tmpfile
+        if only_changed and file_digest(tmpname) == file_digest(fname):
+            logging.debug("%s unchanged" % fname)
+            os.unlink(tmpname)
+            return
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, fname)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+def atomic_write(fname: str, data: bytes) -> None:
+    "write data to fname via a temporary file, so readers never see partial content"
+    with atomic_open(fname) as outfile:
+        outfile.write(data)
+
+
+def file_digest(fname: str) -> Optional[str]:
+    "sha256 of the content of fname, None if it cannot be read"
+    try:
+        with open(fname, 'rb') as infile:
+            return hashlib.sha256(infile.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def default_cachedir(config: CompiledConfig) -> str:
+    "cache directory of the hostlist directory of config below $XDG_CACHE_HOME/hostlist"
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    hostlistdir = os.path.realpath(config.hostlistdir or '.')
+    name = '%s-%s' % (os.path.basename(hostlistdir), hashlib.sha256(hostlistdir.encode()).hexdigest()[:12])
+    return os.path.join(base, 'hostlist', name)
+
+
+def get_cachedir(config: CompiledConfig) -> Optional[str]:
+    "return the cache directory from the config, None if caching is disabled"
+    cachedir = config.get('cache_dir', default_cachedir(config))
+    if not cachedir:
+        return None
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+            # keep the cache out of the hostlist repo
+            with open(os.path.join(cachedir, '.gitignore'), 'w') as gitignore:
+                gitignore.write('*\n')
+    except OSError as e:
+        logging.warning("Cannot create cache directory %s: %s" % (cachedir, e))
+        return None
+    return cachedir
+
+
+class ParseCache:
+    """On-disk cache of parsed hostlist files
+
+    Entries are keyed by the hash of the file content and of the config
+    fields used while parsing and hold the pickled (header, hosts) sections.
+    A lock file serializes writers of concurrent runs sharing the cache.
+    """
+
+    def __init__(self, cachedir: str, config: CompiledConfig) -> None:
+        self.dir = os.path.join(cachedir, 'parse')
+        self.lockfile = os.path.join(cachedir, 'lock')
+        self.max_age = config.get('cache_max_age', 30) * 24 * 3600
+        os.makedirs(self.dir, exist_ok=True)
+        self.confighash = '%s-%s' % (FORMAT_VERSION, config.parse_digest)
+
+    @classmethod
+    def from_config(cls, config: CompiledConfig) -> Optional['ParseCache']:
+        "return the cache configured in config, None if disabled"
+        cachedir = get_cachedir(config)
+        if cachedir is None:
+            return None
+        return cls(cachedir, config)
+
+    @contextlib.contextmanager
+    def lock(self, exclusive: bool=False):
+        with open(self.lockfile, 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def key(self, content: bytes) -> str:
+        return hashlib.sha256(self.confighash.encode() + content).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, key + '.pickle')
+
+    def get(self, key: str):
+        "return the cached sections for key, None if not cached"
+        path = self._path(key)
+        try:
+            with self.lock():
+                with open(path, 'rb') as entry:
+                    sections = pickle.load(entry)
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug("Ignoring broken cache entry %s: %s" % (path, e))
+            return None
+        return sections
+
+    def put(self, key: str, sections) -> None:
+        try:
+            data = pickle.dumps(sections, protocol=pickle.HIGHEST_PROTOCOL)
+            with self.lock(exclusive=True):
+                atomic_write(self._path(key), data)
+        except Exception as e:
+            logging.warning("Failed to write cache entry: %s" % e)
+
+    def evict(self) -> None:
+        "remove entries that have not been used for cache_max_age days"
+        oldest = time.time() - self.max_age
+        with self.lock(exclusive=True):
+            for entry in os.scandir(self.dir):
+                try:
+                    if entry.stat().st_mtime < oldest:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+class CheckResult:
+    "Outcome of one check"
+
+    def __init__(self, name: str, hosts: int) -> None:
+        self.name = name
+        self.hosts = hosts
+        self.success = True
+        self.ignored = False
+        self.duration = 0.0
+        self.failures = []  # type: list
+
+    def as_dict(self) -> dict:
+        return {
+            'success': self.success,
+            'ignored': self.ignored,
+            'duration': round(self.duration, 6),
+            'hosts': self.hosts,
+            'failures': self.failures,
+        }
+
+
+class _FailureHandler(logging.Handler):
+    "records the errors logged by a check in the result of the running check"
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.current = threading.local()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        result = getattr(self.current, 'result', None)
+        if result is not None:
+            result.failures.append(record.getMessage())
+
+
+class CheckRunner:
+    """Runs independent checks concurrently and collects all results
+
+    A check is a callable returning True on success. Everything it logs
+    as error is recorded as failure of that check. Checks run in a thread
+    pool, as they share the (large) hostlist and its indexes read-only.
+    """
+
+    def __init__(self, jobs: Optional[int]=None) -> None:
+        self.jobs = jobs
+        self.results = {}  # type: Dict[str, CheckResult]
+        self.duration = 0.0
+
+    def run(self, checks: Dict[str, Tuple[Callable[[], bool], int]]) -> Dict[str, CheckResult]:
+        "run checks, given as name: (check, number of hosts examined)"
+        handler = _FailureHandler()
+        logging.getLogger().addHandler(handler)
+        start = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs or len(checks) or 1) as executor:
+                futures = [executor.submit(self._run_one, handler, name, check, hosts)
+                           for name, (check, hosts) in checks.items()]
+                for future in futures:
+                    result = future.result()
+                    self.results[result.name] = result
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.duration = time.perf_counter() - start
+        return self.results
+
+    @staticmethod
+    def _run_one(handler: _FailureHandler, name: str, check: Callable[[], bool], hosts: int) -> CheckResult:
+        result = CheckResult(name, hosts)
+        handler.current.result = result
+        start = time.perf_counter()
+        try:
+            result.success = bool(check())
+        except Exception as e:
+            logging.exception("Check %s failed: %s" % (name, e))
+            result.success = False
+        finally:
+            result.duration = time.perf_counter() - start
+            handler.current.result = None
+        return result
+
+    @property
+    def success(self) -> bool:
+        return all(r.success or r.ignored for r in self.results.values())
+
+    def report(self) -> dict:
+        return {
+            'success': self.success,
+            'duration': round(self.duration, 6),
+            'checks': {name: result.as_dict() for name, result in self.results.items()},
+        }
+
+    def write_report(self, fname: str) -> None:
+        "write the results as json to fname"
+        with open(fname, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+            outfile.write('\n')
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+import logging
+import os
+import pickle
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .cache import atomic_write, get_cachedir
+from .config import CompiledConfig
+from .hostindex import HostIndex
+
+# bump whenever the layout of the saved state changes
+FORMAT_VERSION = 1
+
+
+class HostRecord:
+    "the properties of a host the cross-host checks need, kept between runs"
+
+    __slots__ = ('text', 'fqdn', 'ip', 'mac', 'hostname', 'vars')
+    groups = frozenset()  # type: frozenset
+
+    def __init__(self, h) -> None:
+        self.text = str(h)
+        self.fqdn = h.fqdn
+        self.ip = h.ip
+        self.mac = h.mac
+        self.hostname = h.hostname
+        self.vars = {'unique': bool(h.vars['unique'])}
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state) -> None:
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+
+def cnames_digest(cnames: Iterable) -> str:
+    return hashlib.sha256('\n'.join('%s %s' % (c.fqdn, c.dest) for c in cnames).encode()).hexdigest()
+
+
+class CheckState:
+    """Global index of the last hostlist that passed all checks
+
+    Keeps per hostlist file the digest of its content, a HostRecord per
+    host, the ipranges of its sections and indexes every host by fqdn, ip,
+    mac and hostname. Files are replaced one by one; the keys of their old
+    and new hosts are collected in touched, so only these need to be checked
+    again. The state is stored in the cache directory.
+    """
+
+    def __init__(self, fname: Optional[str], config: CompiledConfig) -> None:
+        self.fname = fname
+        self.config = config.digest
+        self.cnames = None  # type: Optional[str]
+        self.digests = {}  # type: Dict[str, Optional[str]]
+        self.records = {}  # type: Dict[str, List[HostRecord]]
+        self.ranges = {}  # type: Dict[str, List[tuple]]
+        self.index = {prop: {} for prop in HostIndex.PROPS}  # type: Dict[str, Dict]
+        self.changed = set()  # type: Set[str]
+        self.touched = {}  # type: Dict[str, Set]
+        self.reset_changes()
+
+    @classmethod
+    def from_config(cls, config: CompiledConfig) -> Optional['CheckState']:
+        "load the state saved for config, an empty state if there is none, None if caching is disabled"
+        cachedir = get_cachedir(config)
+        if cachedir is None:
+            return None
+        fname = os.path.join(cachedir, 'checkstate.pickle')
+        try:
+            with open(fname, 'rb') as infile:
+                version, state = pickle.load(infile)
+            if version == FORMAT_VERSION and state.config == config.digest:
+                state.fname = fname
+                return state
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.debug("Ignoring broken check state %s: %s" % (fname, e))
+        return cls(fname, config)
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        del state['fname'], state['changed'], state['touched']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.fname = None
+        self.reset_changes()
+
+    def save(self) -> None:
+        if not self.fname:
+            return
+        try:
+            atomic_write(self.fname, pickle.dumps((FORMAT_VERSION, self), protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logging.warning("Failed to write check state %s: %s" % (self.fname, e))
+
+    @property
+    def empty(self) -> bool:
+        return not self.digests
+
+    def _keys(self, record: HostRecord) -> Iterator[Tuple[str, object]]:
+        for prop in HostIndex.PROPS:
+            key = getattr(record, prop)
+            if key is not None:
+                yield prop, key
+
+    def remove_file(self, fname: str) -> None:
+        "drop all hosts of fname"
+        self.changed.add(fname)
+        self.digests.pop(fname, None)
+        self.ranges.pop(fname, None)
+        for record in self.records.pop(fname, []):
+            for prop, key in self._keys(record):
+                self.touched[prop].add(key)
+                entries = self.index[prop].get(key)
+                if entries is None:
+                    continue
+                entries[:] = [entry for entry in entries if entry[0] != fname]
+                if not entries:
+                    del self.index[prop][key]
+
+    def set_file(self, fname: str, digest: Optional[str], sections: Iterable[Tuple[str, dict, list]]) -> None:
+        "replace the hosts of fname by the (name, header, hosts) sections"
+        self.remove_file(fname)
+        self.digests[fname] = digest
+        records, ranges = [], []  # type: Tuple[List[HostRecord], list]
+        for name, header, hosts in sections:
+            first = len(records)
+            records.extend(HostRecord(h) for h in hosts)
+            if 'iprange' in header:
+                low, high = header['iprange']
+                ranges.append((name, low, high, header.get('iprange_allow_overlap', False), first, len(records)))
+        self.records[fname] = records
+        self.ranges[fname] = ranges
+        for pos, record in enumerate(records):
+            for prop, key in self._keys(record):
+                self.touched[prop].add(key)
+                bisect.insort(self.index[prop].setdefault(key, []), (fname, pos))
+
+    def sync(self, files: Dict[str, list], digests: Dict[str, Optional[str]],
+             named_sections) -> Set[str]:
+        """update to the parsed files, returns the names of the changed ones
+
+        files maps file names to their sections, named_sections(fname, sections)
+        yields their (name, header, hosts). Files without digest always count as changed."""
+
+        for fname in set(self.digests) - set(files):
+            self.remove_file(fname)
+        for fname, sections in files.items():
+            digest = digests.get(fname)
+            if digest is None or self.digests.get(fname) != digest:
+                self.set_file(fname, digest, named_sections(fname, sections))
+        return self.changed
+
+    def reset_changes(self) -> None:
+        "forget the changed files and touched keys"
+        self.changed = set()
+        self.touched = {prop: set() for prop in HostIndex.PROPS}
+
+    def lookup(self, prop: str, key) -> List[HostRecord]:
+        "hosts with the given key, in hostlist order"
+        return [self.records[fname][pos] for fname, pos in self.index[prop].get(key, [])]
+
+    def conflicts(self, prop: str) -> Iterator[Tuple[object, List[HostRecord]]]:
+        "yield the touched keys of prop shared by more than one host, in hostlist order"
+        keys = [key for key in self.touched[prop] if len(self.index[prop].get(key, ())) > 1]
+        for key in sorted(keys, key=lambda k: self.index[prop][k][0]):
+            yield key, self.lookup(prop, key)
+
+    def sections(self) -> Iterator[Tuple[str, dict, list]]:
+        "yield (name, header, hosts) of all sections with iprange in hostlist order"
+        for fname in sorted(self.ranges):
+            records = self.records[fname]
+            for name, low, high, allow, first, last in self.ranges[fname]:
+                header = {'iprange': (low, high), 'iprange_allow_overlap': allow}
+                yield name, header, records[first:last]
+
+    def touched_sections(self) -> Set[str]:
+        "names of the sections of changed files"
+        return {section[0] for fname in self.changed for section in self.ranges.get(fname, [])}
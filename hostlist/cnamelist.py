@@ -2,9 +2,9 @@
 
 import logging
 from types import SimpleNamespace
-from typing import Dict
+from typing import Dict, Optional
 
-from .config import CONFIGINSTANCE as Config
+from .config import CONFIGINSTANCE as Config, CompiledConfig
 
 
 class CNamelist(list):
@@ -34,9 +34,11 @@ class CNamelist(list):
 class FileCNamelist(CNamelist):
     "File based CNamelist"
 
-    def __init__(self) -> None:
+    def __init__(self, config: Optional[CompiledConfig]=None) -> None:
+        if config is None:
+            config = Config.compiled()
         source = 'cnames'  # TODO: move to config
-        fname = Config["hostlistdir"] + source
+        fname = config.hostlistdir + source
         try:
             infile = open(fname)
         except:
@@ -2,6 +2,77 @@
 
 import yaml
 import logging
+import hashlib
+import ipaddress
+import itertools
+import json
+from typing import Optional, Union, cast
+
+# config fields that influence how a hostlist file is parsed
+PARSE_CONFIG_KEYS = ('domain', 'iprange', 'groups')
+
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# versions of the compiled configs, shared by all Config objects
+_versions = itertools.count(1)
+
+
+def _digest(data) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _network(iprange: dict, name: str) -> Optional[IPNetwork]:
+    return ipaddress.ip_network(iprange[name]) if name in iprange else None
+
+
+class CompiledConfig:
+    """Immutable snapshot of the config settings
+
+    Values needed per host are derived once: the ip networks, lookup sets
+    and the default groups. version numbers the snapshots of all configs in
+    the order they were compiled, digest identifies the settings and
+    parse_digest the settings used while parsing.
+    """
+
+    __slots__ = ('_raw', 'version', 'digest', 'parse_digest', 'domain', 'hostlistdir',
+                 'internal', 'external', 'nonunique_ips', 'ignore_checks',
+                 'ansiblevars', 'default_groups', '_frozen')
+
+    def __init__(self, config: dict, version: int=0) -> None:
+        config = dict(config)
+        iprange = config.get('iprange') or {}
+        self._raw = config
+        self.version = version
+        self.digest = _digest(config)
+        self.parse_digest = _digest({k: config.get(k) for k in PARSE_CONFIG_KEYS})
+        # required settings, None only with a broken config
+        self.domain = cast(str, config.get('domain'))
+        self.hostlistdir = cast(str, config.get('hostlistdir'))
+        self.internal = _network(iprange, 'internal')
+        self.external = _network(iprange, 'external')
+        self.nonunique_ips = frozenset(config.get('nonunique_ips') or [])
+        self.ignore_checks = frozenset(config.get('ignore_checks') or [])
+        self.ansiblevars = tuple(config.get('ansiblevars') or []) + ('hosttype', 'institute', 'docker')
+        self.default_groups = frozenset(config.get('groups') or [])
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("CompiledConfig is immutable")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return (self.__class__, (self._raw, self.version))
+
+    def __getitem__(self, key):
+        return self._raw[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._raw
+
+    def get(self, key, default=None):
+        return self._raw.get(key, default)
 
 
 class Config(dict):
@@ -10,25 +81,76 @@ class Config(dict):
 
     def __init__(self):
         self._loaded = False
+        self._compiled = None
 
     def __getitem__(self, *args):
         if not self._loaded:
             self.load()
         return dict.__getitem__(self, *args)
 
+    # every change drops the compiled snapshot
+    def __setitem__(self, *args):
+        self._compiled = None
+        return dict.__setitem__(self, *args)
+
+    def __delitem__(self, *args):
+        self._compiled = None
+        return dict.__delitem__(self, *args)
+
+    def update(self, *args, **kwargs):
+        self._compiled = None
+        return dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self._compiled = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._compiled = None
+        return dict.popitem(self)
+
+    def setdefault(self, *args):
+        self._compiled = None
+        return dict.setdefault(self, *args)
+
+    def clear(self):
+        self._compiled = None
+        return dict.clear(self)
+
+    def set(self, newconfig):
+        "replace the settings by the ones in newconfig"
+        self.clear()
+        self.update(newconfig)
+        self._loaded = True
+        self._compiled = None
+
+    def compiled(self) -> CompiledConfig:
+        "return an immutable snapshot of the current settings"
+        if not self._loaded:
+            self.load()
+        if self._compiled is None:
+            self._compiled = CompiledConfig(self, next(_versions))
+        return self._compiled
+
     def load(self):
         "read config from file"
         try:
             with open(self.CONFIGNAME, 'r') as configfile:
                 newconfig = yaml.safe_load(configfile)
-                self.clear()
-                self.update(newconfig)
+            self.set(newconfig)
             logging.info("loaded " + self.CONFIGNAME)
-            self._loaded = True
         except:
             logging.error("failed to load " + self.CONFIGNAME)
             self._loaded = False
         return self._loaded
 
 
+def load_compiled() -> CompiledConfig:
+    "read the config file into a new snapshot, leaving CONFIGINSTANCE as it is"
+    config = Config()
+    if not config.load():
+        raise Exception("failed to load " + Config.CONFIGNAME)
+    return config.compiled()
+
+
 CONFIGINSTANCE = Config()
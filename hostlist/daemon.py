@@ -4,45 +4,352 @@
 # from distutils.util import strtobool
 # import sys
 
+import os
 import git
+import copy
+import time
 import datetime
+import gzip
+import hashlib
+import io
+import functools
+import ipaddress
+import operator
+import threading
+import collections
+import concurrent.futures
 import cherrypy
 from cherrypy import log
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
 
 from . import hostlist
 from . import cnamelist
-from .output_services import Output_Services
-from .config import CONFIGINSTANCE as Config
+from .output_services import Output_Services, Output_Classes
+from .query import Query
+from .config import load_compiled
+
+# parameters selecting a part of the hosts, also given as /<service>/<param>/<value>
+SHARD_PARAMS = ('group', 'institute', 'subnet')
+
+
+def _gzip(data):
+    "gzip data without a timestamp, so the same output compresses the same"
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as compressed:
+        compressed.write(data)
+    return out.getvalue()
+
+
+# content encodings outputs are compressed with, in order of preference
+ENCODINGS = [('gzip', _gzip)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', lambda data: brotli.compress(data, quality=9)))
+if zstandard is not None:
+    ENCODINGS.insert(0, ('zstd', lambda data: zstandard.ZstdCompressor(level=10).compress(data)))
+# outputs smaller than this are only sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+# other names clients may accept an encoding by
+ENCODING_ALIASES = {'x-gzip': 'gzip'}
+
+class ShardCache():
+    """Rendered shards (outputs for a part of the hosts) of one snapshot
+
+    Maps (service, bitset of the hosts) to the future of the ETag and encoded
+    output. The least recently used shards are dropped beyond max_count of
+    them or max_bytes of their encoded outputs, failed ones right away."""
+
+    max_count = 1024
+    max_bytes = 64 << 20
+
+    def __init__(self):
+        self._futures = collections.OrderedDict()
+        self._sizes = {}
+        self.size = 0
+        # reentrant, the callback of an already done future runs at once
+        self._lock = threading.RLock()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._futures))
+
+    def get(self, key, render):
+        "the future of shard key, render() starts rendering it if it is not kept"
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self._futures.move_to_end(key)
+                return future
+            future = self._futures[key] = render()
+            future.add_done_callback(lambda future: self._rendered(key, future))
+            self._evict()
+            return future
+
+    def drop(self, service):
+        "forget the shards of service"
+        with self._lock:
+            for key in [key for key in self._futures if key[0] == service]:
+                del self._futures[key]
+                self.size -= self._sizes.pop(key, 0)
+
+    def _rendered(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is not future:
+                return
+            if future.exception() is not None:
+                del self._futures[key]
+                return
+            self._sizes[key] = sum(len(data) for data in future.result()[1].values())
+            self.size += self._sizes[key]
+            self._evict()
+
+    def _evict(self):
+        while len(self._futures) > self.max_count or self.size > self.max_bytes:
+            key, _ = self._futures.popitem(last=False)
+            self.size -= self._sizes.pop(key, 0)
+
+
+class Snapshot():
+    """Everything served for one state of the hosts repo
+
+    Built completely off the request path and published by replacing
+    Inventory.snapshot, so every request sees one consistent state.
+    Outputs are rendered per generation, the commit and config, and again
+    when their other inputs change, inputs holds their inputs_version.
+    stale holds the last successful outputs of the services that may be
+    served stale, starting with those of the previous snapshot. Only the
+    renders of this snapshot replace them, so late ones of an older
+    snapshot or a replaced render cannot bring back older outputs."""
+
+    def __init__(self, commit, config, hostlist, cnames, info, pull_failed, previous=None):
+        self.commit = commit
+        self.config = config
+        self.hostlist = hostlist
+        self.cnames = cnames
+        self.generation = '%s-%s' % (commit, config.digest[:12])
+        self.rendered = {}
+        self.inputs = {}
+        self.stale = dict(previous.stale) if previous is not None else {}
+        self.info = info
+        self.pull_failed = pull_failed
+        self.refresh_failed = False
+        self.last_update = datetime.datetime.now()
+        self.shards = ShardCache()
+
+    def copy(self):
+        "a copy of this snapshot whose outputs can be replaced without changing this one"
+        snapshot = copy.copy(self)
+        snapshot.rendered = dict(self.rendered)
+        snapshot.inputs = dict(self.inputs)
+        snapshot.stale = dict(self.stale)
+        for service, future in snapshot.rendered.items():
+            snapshot.keep_stale(service, future)
+        return snapshot
+
+    def refreshed(self, pull_failed):
+        "this snapshot after a refresh that found nothing new"
+        snapshot = self.copy()
+        snapshot.pull_failed = pull_failed
+        snapshot.refresh_failed = False
+        snapshot.last_update = datetime.datetime.now()
+        return snapshot
+
+    def failed(self):
+        "this snapshot after a refresh that failed"
+        snapshot = copy.copy(self)
+        snapshot.refresh_failed = True
+        return snapshot
+
+    def keep_stale(self, service, future):
+        "keep the output of future as the stale output of service once it succeeded"
+        def done(future):
+            if future.exception() is None and self.rendered.get(service) is future:
+                self.stale[service] = future.result()
+        if Output_Classes[service].stale_ok:
+            future.add_done_callback(done)
+
 
 class Inventory():
+    # seconds to wait for more refresh triggers before refreshing
+    refresh_delay = 2
+    # minimal seconds between the start of two refreshes
+    refresh_interval = 10
+    # minimal seconds between two checks of the other inputs of a service while serving it
+    inputs_interval = 10
 
     def __init__(self):
         try:
             self.repo = git.Repo('.')
         except git.InvalidGitRepositoryError:
             self.repo = git.Repo('../')
-        self.last_update = None
-        self.fetch_hostlist()
-        self.pull_failed = False
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+        self._last_refresh = time.monotonic()
+        # held while replacing the snapshot
+        self._publish_lock = threading.Lock()
+        self._inputs_checked = {}
+        self.snapshot = self._build(None)
+        self._refresh_requested = threading.Event()
+        threading.Thread(target=self._refresh_loop, name='refresher', daemon=True).start()
 
-    def fetch_hostlist(self, timeout=600):
-        if self.last_update and datetime.datetime.now() - self.last_update < datetime.timedelta(seconds=timeout):
-            return
-        self.last_update = datetime.datetime.now()
+    def request_refresh(self):
+        "schedule a refresh, triggers until it starts are handled by that one"
+        self._refresh_requested.set()
+
+    def _refresh_loop(self):
+        while True:
+            self._refresh_requested.wait()
+            time.sleep(max(self.refresh_delay, self._last_refresh + self.refresh_interval - time.monotonic()))
+            self._refresh_requested.clear()
+            self._last_refresh = time.monotonic()
+            self.refresh()
 
+    def refresh(self):
+        "build and publish a new snapshot, the current one stays if that fails"
+        try:
+            snapshot = self._build(self.snapshot)
+        except Exception as e:
+            log("Refresh failed, still serving %s: %s" % (self.snapshot.generation, e))
+            with self._publish_lock:
+                self.snapshot = self.snapshot.failed()
+            return False
+        with self._publish_lock:
+            self.snapshot = snapshot
+        print("Refreshed cache.")
+        return True
+
+    def _build(self, previous):
+        """pull the hosts repo and return the snapshot of its head
+
+        Only the files changed since the previous snapshot are parsed again."""
+
+        pull_failed = False
         try:
             pullresult = self.repo.remote().pull()[-1]
-            if not pullresult.flags & pullresult.HEAD_UPTODATE:
-                self.pull_failed = True
+            if pullresult.flags & (pullresult.REJECTED | pullresult.ERROR):
+                pull_failed = True
                 log("Hosts repo not up to date after pull.")
-        except:
+        except Exception:
             log("Failed to pull hosts repo.")
-            self.pull_failed = True
-        Config.load()
-        self.hostlist = hostlist.YMLHostlist()
-        self.cnames = cnamelist.FileCNamelist()
-        self.pull_failed = False
-        print("Refreshed cache.")
+            pull_failed = True
+        commit = self.repo.head.commit.hexsha
+        # also local changes of the config, which the diff does not show
+        config = load_compiled()
+        if previous is not None and config.digest == previous.config.digest:
+            config = previous.config
+        changed = None
+        if previous is not None and config is previous.config:
+            changed = self._changed_files(previous, commit)
+        if changed is None:
+            hosts = hostlist.YMLHostlist(config=config)
+            cnames = cnamelist.FileCNamelist(config)
+        else:
+            hosts, cnames = previous.hostlist, previous.cnames
+            hostfiles, cnames_changed = changed
+            if hostfiles:
+                hosts = hosts.updated(hostfiles)
+            if cnames_changed:
+                cnames = cnamelist.FileCNamelist(config)
+        if previous is not None and commit == previous.commit and config is previous.config:
+            snapshot = previous.refreshed(pull_failed)
+            self._render_changed_inputs(snapshot)
+            return snapshot
+        snapshot = Snapshot(commit, config, hosts, cnames, self._repo_info(), pull_failed, previous)
+        for service in Output_Services:
+            self._start_render(snapshot, service)
+        return snapshot
+
+    def _start_render(self, snapshot, service):
+        "start rendering service for snapshot in the worker pool"
+        snapshot.inputs[service] = Output_Classes[service].inputs_version(snapshot.config)
+        future = snapshot.rendered[service] = self.executor.submit(
+                self._render, service, snapshot.hostlist, snapshot.cnames)
+        snapshot.keep_stale(service, future)
+
+    def _render_changed_inputs(self, snapshot):
+        "render the services of snapshot whose inputs other than hosts and cnames changed again"
+        for service, inputs in list(snapshot.inputs.items()):
+            if inputs is None or Output_Classes[service].inputs_version(snapshot.config) == inputs:
+                continue
+            log("Inputs of %s changed, rendering it again." % service)
+            self._start_render(snapshot, service)
+            snapshot.shards.drop(service)
+
+    def _check_inputs(self, service):
+        """the current snapshot, with service rendered again if its inputs other
+        than hosts and cnames changed
+
+        Checked at most every inputs_interval seconds, without pulling the hosts repo."""
+        now = time.monotonic()
+        with self._publish_lock:
+            snapshot = self.snapshot
+            inputs = snapshot.inputs.get(service)
+            checked = self._inputs_checked.get(service)
+            if inputs is None or (checked is not None and now - checked < self.inputs_interval):
+                return snapshot
+            self._inputs_checked[service] = now
+            if Output_Classes[service].inputs_version(snapshot.config) == inputs:
+                return snapshot
+            log("Inputs of %s changed, rendering it again." % service)
+            snapshot = snapshot.copy()
+            self._start_render(snapshot, service)
+            snapshot.shards.drop(service)
+            self.snapshot = snapshot
+            return snapshot
+
+    @staticmethod
+    def _render(service, hostlist, cnames):
+        "returns the ETag and the encoded output of service by content encoding"
+        content = ''.join(Output_Classes[service].iter_content(hostlist, cnames)).encode('utf8')
+        variants = {'identity': content}
+        if len(content) >= COMPRESS_MIN_SIZE:
+            for encoding, compress in ENCODINGS:
+                variants[encoding] = compress(content)
+        return '"%s"' % hashlib.sha256(content).hexdigest(), variants
+
+    def _repo_info(self):
+        branch = self.repo.active_branch
+        return {
+            'branch': str(branch),
+            'commit': str(branch.commit),
+            'summary': str(branch.commit.summary),
+            'author': str(branch.commit.author),
+        }
+
+    def _changed_files(self, previous, commit):
+        """find the hostlist files changed since the commit of the previous snapshot
+
+        returns the changed yml files and whether the cnames changed,
+        or None if everything has to be loaded again. Changes of the config
+        are found by its digest instead."""
+
+        if previous.commit == commit:
+            return [], False
+        try:
+            # renames as removal and addition, so the sections of the old name are dropped
+            diff = self.repo.git.diff('--name-only', '--no-renames', previous.commit, commit)
+        except git.GitCommandError:
+            log("Failed to diff against last loaded commit, reloading all files.")
+            return None
+
+        hostlistdir = os.path.realpath(previous.config.hostlistdir)
+        hostfiles, cnames_changed = [], False
+        for path in diff.splitlines():
+            path = os.path.realpath(os.path.join(self.repo.working_tree_dir, path))
+            if os.path.dirname(path) != hostlistdir:
+                continue
+            name = os.path.basename(path)
+            if name.endswith('.yml'):
+                hostfiles.append(os.path.join(previous.config.hostlistdir, name))
+            elif name == 'cnames':
+                cnames_changed = True
+        log("Changed since %s: %s" % (previous.commit, ', '.join(hostfiles) or 'no hostlists'))
+        return hostfiles, cnames_changed
 
     def _cp_dispatch(self,vpath):
         if len(vpath) == 0:
@@ -51,33 +358,189 @@ class Inventory():
         param = vpath.pop(0)
         if param in Output_Services:
             cherrypy.request.params['service'] = param
+            while len(vpath) >= 2 and vpath[0] in SHARD_PARAMS:
+                name, value = vpath.pop(0), vpath.pop(0)
+                if name == 'subnet' and vpath and vpath[0].isdigit():
+                    # the prefix length of /subnet/192.0.2.0/24
+                    value += '/' + vpath.pop(0)
+                cherrypy.request.params.setdefault(name, [])
+                if not isinstance(cherrypy.request.params[name], list):
+                    cherrypy.request.params[name] = [cherrypy.request.params[name]]
+                cherrypy.request.params[name].append(value)
         return self
 
     @cherrypy.expose
     @cherrypy.config(**{'tools.caching.delay': 10})
     def refreshcache(self):
         cherrypy.lib.caching.cherrypy._cache.clear()
-        self.fetch_hostlist(timeout=10)
+        self.request_refresh()
 
     @cherrypy.expose
-    def index(self, service='index'):
+    @cherrypy.config(**{'response.stream': True, 'tools.caching.on': False})
+    def index(self, service='index', q=None, group=None, institute=None, subnet=None):
         if service != 'index':
-            return Output_Services[service](self.hostlist, self.cnames)
+            if q or group or institute or subnet:
+                return self._serve_shard(service, q, group, institute, subnet)
+            return self._serve(service)
+        snapshot = self.snapshot
         servicelist = sorted(list(Output_Services.keys()))
-        branch = self.repo.active_branch
-        out = 'Last update: ' + str(self.last_update)
-        out += ' <b>(failed)</b><br>' if self.pull_failed else '<br>'
-        out += 'Branch:{0}<br>Commit:{1} <b>{2}</b> ({3})<br><br>'.format(
-                str(branch),
-                str(branch.commit),
-                str(branch.commit.summary),
-                str(branch.commit.author)
-                )
+        out = 'Last update: ' + str(snapshot.last_update)
+        out += ' <b>(failed)</b><br>' if snapshot.pull_failed or snapshot.refresh_failed else '<br>'
+        out += 'Branch:{branch}<br>Commit:{commit} <b>{summary}</b> ({author})<br><br>'.format(**snapshot.info)
         out += 'Available hostlists:<br>'
         out += ''.join(list(map(lambda s: '<a href="/{0}">{0}</a><br>'.format(s), servicelist)))
         out += '<br><br><i>See <a href="https://github.com/particleKIT/hostlist">github.com/particleKIT/hostlist</a> how to use this API.</i>'
         return out
 
+    def _serve(self, service):
+        """send the rendered output of service, or 304 if the client has it already
+
+        Services with stale_ok get their last output while rendering a new
+        one or if that failed."""
+
+        snapshot = self._check_inputs(service)
+        future = snapshot.rendered[service]
+        stale = snapshot.stale.get(service)
+        if stale is not None and not future.done():
+            etag, variants = stale
+        else:
+            try:
+                etag, variants = future.result()
+            except Exception as e:
+                log("Rendering %s failed: %s" % (service, e))
+                if stale is None:
+                    # sent in chunks while rendering
+                    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+                    return Output_Classes[service].iter_content(snapshot.hostlist, snapshot.cnames)
+                etag, variants = stale
+        return self._send(etag, variants)
+
+    def _serve_shard(self, service, q, group, institute, subnet):
+        """send service for a shard, the hosts matching the query q and any
+        of the given groups, institutes and subnets
+
+        Shards are kept by the hosts they select, so the same hosts are only
+        rendered once per snapshot, and all hosts are the unsharded output."""
+
+        snapshot = self.snapshot
+        index = snapshot.hostlist.groups
+        try:
+            bits = self._shard_bits(index, q, _values(group), _values(institute),
+                                    [ipaddress.ip_network(net, strict=False) for net in _values(subnet)])
+        except Exception as e:
+            raise cherrypy.HTTPError(400, "Invalid shard: %s" % e)
+        if bits == index.all:
+            return self._serve(service)
+        future = snapshot.shards.get((service, bits), lambda: self.executor.submit(
+                self._render_shard, service, snapshot.hostlist, snapshot.cnames, bits))
+        try:
+            etag, variants = future.result()
+        except Exception as e:
+            log("Rendering %s for a shard failed: %s" % (service, e))
+            # sent in chunks while rendering, like a failed full output
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            return Output_Classes[service].iter_content(
+                    self._shard_hosts(snapshot.hostlist, bits), snapshot.cnames)
+        return self._send(etag, variants)
+
+    @staticmethod
+    def _shard_bits(index, q, groups, institutes, subnets):
+        "bitset of the hosts of the shard in the group index"
+        bits = index.all if not q else _compile_query(q).bits(index)
+        if groups:
+            bits &= index.select(groups)
+        if institutes:
+            bits &= _union(index.matching('institute', institute) for institute in institutes)
+        if subnets:
+            bits &= _union(index.in_network(net) for net in subnets)
+        return bits
+
+    @classmethod
+    def _render_shard(cls, service, full, cnames, bits):
+        "returns the ETag and encoded output of service for the hosts in bits"
+        return cls._render(service, cls._shard_hosts(full, bits), cnames)
+
+    @staticmethod
+    def _shard_hosts(full, bits):
+        "hostlist of the hosts in bits of the full one"
+        selected = hostlist.Hostlist(full.config)
+        selected.fileheaders = full.fileheaders
+        selected.extend(full.groups.members(bits))
+        return selected
+
+    @staticmethod
+    def _send(etag, variants):
+        """send the variant of the output the client accepts, or 304 if it has it already
+
+        Compressed variants have their own ETag."""
+
+        encoding = _choose_encoding(cherrypy.request.headers.get('Accept-Encoding', ''), variants)
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is None:
+            raise cherrypy.HTTPError(406, "No acceptable content encoding")
+        if encoding != 'identity':
+            cherrypy.response.headers['Content-Encoding'] = encoding
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        cherrypy.response.headers['ETag'] = etag
+        if _etag_matches(cherrypy.request.headers.get('If-None-Match', ''), etag):
+            cherrypy.response.status = 304
+            return b''
+        return variants[encoding]
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_query(q):
+    return Query(q)
+
+
+def _union(bitsets):
+    return functools.reduce(operator.or_, bitsets, 0)
+
+
+def _values(param):
+    "the sorted values of a parameter given once, several times or not at all"
+    if param is None:
+        return ()
+    if isinstance(param, str):
+        param = [param]
+    return tuple(sorted(set(param)))
+
+
+def _choose_encoding(header, variants):
+    """the encoding of variants the Accept-Encoding header prefers
+
+    identity is sent if the header accepts no other encoding, or prefers it
+    explicitly, and None if it refuses identity too."""
+    accepted = {}
+    for item in header.split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        name = name.strip().lower()
+        accepted[ENCODING_ALIASES.get(name, name)] = quality
+    best, best_quality = None, 0.0
+    for encoding, _ in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if encoding in variants and quality > best_quality:
+            best, best_quality = encoding, quality
+    # identity is acceptable unless refused, but only preferred if asked for
+    identity = accepted.get('identity', accepted.get('*', 1.0))
+    if (best is None and identity > 0) or ('identity' in accepted and identity > best_quality):
+        return 'identity'
+    return best
+
+
+def _etag_matches(header, etag):
+    "whether an If-None-Match header matches etag"
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
 
 def _auth_config(app):
     if app.config.get('/', {}).get('tools.auth_digest.on', False):
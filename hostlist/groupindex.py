@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import bisect
+import ipaddress
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+
+class GroupIndex(Mapping):
+    """Members of each group as bitsets
+
+    Every added host gets the next host id, bit i of the bitset of a group
+    is set if host i is a member. So members are in order of addition and
+    unions, intersections and differences of groups are integer operations.
+    Maps group names to the lists of their members, unknown groups have none.
+    Hosts are also indexed by hostname and fqdn, all is the bitset of every
+    host. The hosts by value of a variable and by ip are indexed on first use.
+    Removed hosts leave a gap, the ids are renumbered once most are gaps.
+    """
+
+    # fewer hosts ids are not renumbered
+    compact_min = 64
+
+    def __init__(self, hosts: Iterable=()) -> None:
+        self._clear()
+        for h in hosts:
+            self.add(h)
+
+    def _clear(self) -> None:
+        # None for the ids of removed hosts
+        self.hosts = []  # type: list
+        self._ids = {}  # type: Dict[int, int]
+        self._bits = {}  # type: Dict[str, int]
+        self._names = {}  # type: Dict[str, int]
+        self._values = {}  # type: Dict[str, Dict[str, int]]
+        self._addresses = {}  # type: Dict[int, List[Tuple[int, int]]]
+        self.all = 0
+
+    def add(self, h) -> None:
+        if id(h) in self._ids:
+            raise Exception("Host %s is already in the group index." % h.hostname)
+        hid = len(self.hosts)
+        self.hosts.append(h)
+        self._ids[id(h)] = hid
+        bit = 1 << hid
+        self.all |= bit
+        bits = self._bits
+        for group in h.groups:
+            bits[group] = bits.get(group, 0) | bit
+        for name in self._hostnames(h):
+            self._names[name] = self._names.get(name, 0) | bit
+        self._values = {}
+        self._addresses = {}
+
+    def remove(self, h) -> None:
+        hid = self._ids.pop(id(h), None)
+        if hid is None:
+            return
+        self.hosts[hid] = None
+        mask = ~(1 << hid)
+        self.all &= mask
+        for group in h.groups:
+            bits = self._bits[group] & mask
+            if bits:
+                self._bits[group] = bits
+            else:
+                del self._bits[group]
+        for name in self._hostnames(h):
+            bits = self._names[name] & mask
+            if bits:
+                self._names[name] = bits
+            else:
+                del self._names[name]
+        self._values = {}
+        self._addresses = {}
+        while self.hosts and self.hosts[-1] is None:
+            self.hosts.pop()
+        if len(self.hosts) >= self.compact_min and 2 * len(self._ids) < len(self.hosts):
+            self._compact()
+
+    def _compact(self) -> None:
+        "renumber the hosts without the gaps of removed ones, keeping their order"
+        hosts = [h for h in self.hosts if h is not None]
+        self._clear()
+        for h in hosts:
+            self.add(h)
+
+    @staticmethod
+    def _hostnames(h) -> Set[str]:
+        return {name for name in (h.hostname, h.fqdn) if name}
+
+    def bits(self, group: str) -> int:
+        "bitset of the members of group"
+        return self._bits.get(group, 0)
+
+    def named(self, name: str) -> int:
+        "bitset of the hosts with hostname or fqdn name"
+        return self._names.get(name, 0)
+
+    def matching(self, var: str, value: str) -> int:
+        "bitset of the hosts whose variable var is value, compared as string"
+        return self._value_bits(var).get(value, 0)
+
+    def _value_bits(self, var: str) -> Dict[str, int]:
+        """bitsets of the hosts by their value of var, built on first use
+
+        Only stored once complete, concurrent readers may build it twice."""
+        values = self._values.get(var)
+        if values is None:
+            values = {}
+            for hid, h in enumerate(self.hosts):
+                if h is not None and var in h.vars:
+                    key = str(h.vars[var])
+                    values[key] = values.get(key, 0) | 1 << hid
+            self._values[var] = values
+        return values
+
+    def in_network(self, network: Union[ipaddress.IPv4Network, ipaddress.IPv6Network]) -> int:
+        "bitset of the hosts with an ip in network"
+        addresses = self._sorted_addresses(network.version)
+        first = bisect.bisect_left(addresses, (int(network.network_address), -1))
+        last = bisect.bisect_right(addresses, (int(network.broadcast_address), len(self.hosts)))
+        bits = 0
+        for _, hid in addresses[first:last]:
+            bits |= 1 << hid
+        return bits
+
+    def _sorted_addresses(self, version: int) -> List[Tuple[int, int]]:
+        "sorted (ip, host id) of the hosts with an ip of version, built on first use"
+        addresses = self._addresses.get(version)
+        if addresses is None:
+            addresses = self._addresses[version] = sorted(
+                    (int(h.ip), hid) for hid, h in enumerate(self.hosts)
+                    if h is not None and h.ip and h.ip.version == version)
+        return addresses
+
+    def select(self, include: Iterable[str]=(), exclude: Iterable[str]=()) -> int:
+        "bitset of the hosts in any of the groups include and none of exclude"
+        bits = 0
+        for group in include:
+            bits |= self.bits(group)
+        for group in exclude:
+            bits &= ~self.bits(group)
+        return bits
+
+    def members(self, bits: int) -> List:
+        "the hosts in bitset bits, in order of addition"
+        binary = bin(bits)[:1:-1]
+        hosts = self.hosts
+        result = []
+        hid = binary.find('1')
+        while hid >= 0:
+            result.append(hosts[hid])
+            hid = binary.find('1', hid + 1)
+        return result
+
+    def __getitem__(self, group: str) -> List:
+        return self.members(self.bits(group))
+
+    def __contains__(self, group) -> bool:
+        return group in self._bits
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._bits)
+
+    def __len__(self) -> int:
+        return len(self._bits)
@@ -2,12 +2,84 @@
 
 import ipaddress
 import logging
-import subprocess
 import datetime
 import re
-from typing import Optional, List, Iterable
+import sys
+import weakref
+from collections import ChainMap
+from collections.abc import MutableMapping
+from typing import Optional, Dict, List, Iterable, FrozenSet, Mapping, Union
 
-from .config import CONFIGINSTANCE as Config
+from .config import CONFIGINSTANCE as Config, CompiledConfig
+from .users import get_resolver
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+# one shared frozenset per distinct combination of groups in use
+_GROUPSETS = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+
+
+def intern_groups(groups: Iterable) -> FrozenSet:
+    "return the shared frozenset with the given groups"
+    groupset = frozenset(sys.intern(g) if isinstance(g, str) else g for g in groups)
+    shared = _GROUPSETS.get(groupset)
+    if shared is None:
+        # keyed by a copy, so the entry goes away with the last host using the set
+        shared = _GROUPSETS[frozenset(tuple(groupset))] = groupset
+    return shared
+
+
+_DEFAULT_VARS = {'unique': True}
+
+
+def section_layer(header: Optional[dict], hosttype: str, institute: str) -> Mapping:
+    """return the variables shared by all hosts of a section: filename < header
+
+    Build it once per section and pass it to the YMLHosts of the section."""
+
+    filevars = {'hosttype': hosttype, 'institute': institute}
+    return ChainMap(header if header is not None else {}, filevars, _DEFAULT_VARS)
+
+
+class LayeredVars(MutableMapping):
+    """Variables of a host on top of a layer shared with other hosts
+
+    Lookups fall through from the host's own variables to the shared
+    layer, changes only go to the host's own variables.
+    """
+
+    __slots__ = ('own', 'shared')
+
+    def __init__(self, own: dict, shared: Mapping) -> None:
+        self.own = own
+        self.shared = shared
+
+    def __getitem__(self, key):
+        try:
+            return self.own[key]
+        except KeyError:
+            return self.shared[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+
+    def __delitem__(self, key):
+        del self.own[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.own or key in self.shared
+
+    def __iter__(self):
+        yield from self.own
+        for key in self.shared:
+            if key not in self.own:
+                yield key
+
+    def __len__(self) -> int:
+        return len(set(self.own).union(self.shared))
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
 
 
 class Host:
@@ -15,46 +87,65 @@ class Host:
     Representation of one host with several properties
     """
 
-    def __init__(self, hostname: str, ip: str, is_nonunique: bool=False) -> None:
-        self._set_defaults()
-        self.ip = ipaddress.ip_address(ip)
+    __slots__ = ('vars', 'ip', 'mac', 'hostname', 'publicip', 'header',
+                 'groups', 'prefix', 'domain', 'fqdn', '_aliases')
+
+    def __init__(self,
+                 hostname: str,
+                 ip: str,
+                 is_nonunique: bool=False,
+                 config: Optional[CompiledConfig]=None
+                 ) -> None:
+        if config is None:
+            config = Config.compiled()
+        self._set_defaults(config)
+        self.ip = ipaddress.ip_address(ip)  # type: Optional[IPAddress]
         self.hostname = hostname
         self.vars['unique'] = not is_nonunique
-        self._set_fqdn()
-        self._set_publicip()
+        self._set_fqdn(config)
+        self._set_publicip(config)
 
-    def _set_defaults(self):
-        self.vars = {
-            'unique': True,
-        }  # type: Dict[str, Any] # noqa: F821
+    def _set_defaults(self, config: CompiledConfig):
+        self.vars = LayeredVars({}, _DEFAULT_VARS)  # type: LayeredVars
 
-        self.ip = None  # type: Optional[ipaddress.ip_address]
-        self.mac = None
-        self.hostname = ""  # type: str
+        self.ip = None
+        self.mac = None  # type: Optional[MAC]
+        self.hostname = ""
         self.publicip = True  # type: bool
-        self.header = None  # stores header of input file
-        self.groups = set(Config.get('groups', []))  # type: set
+        self.header = None  # type: Optional[dict]  # stores header of input file
+        self.groups = intern_groups(config.default_groups)  # type: FrozenSet
+        self._aliases = None  # type: Optional[List[str]]
 
-    def _set_fqdn(self):
-        if self.hostname.endswith(Config["domain"]):
+    def _set_fqdn(self, config: CompiledConfig):
+        if self.hostname.endswith(config.domain):
             dot_parts = self.hostname.split('.')
             self.prefix = dot_parts[0]  # type: str
             self.domain = '.'.join(dot_parts[1:])  # type: str
             self.fqdn = self.hostname  # type: str
         else:
-            self.prefix = self.hostname  # type: str
-            self.domain = self.get_domain(self.vars['institute'])  # type: str
-            self.fqdn = self.hostname + '.' + self.domain  # type: str
+            self.prefix = self.hostname
+            self.domain = self.get_domain(self.vars['institute'], config)
+            self.fqdn = self.hostname + '.' + self.domain
 
-    def _set_publicip(self):
-        if not self.ip or self.ip in ipaddress.ip_network(Config["iprange"]["internal"]):
+    def _set_publicip(self, config: CompiledConfig):
+        if not self.ip or (config.internal is not None and self.ip in config.internal):
             self.publicip = False
         else:
-            assert self.ip in ipaddress.ip_network(Config["iprange"]["external"])
+            assert config.external is not None and self.ip in config.external
             self.publicip = True
 
-    def get_domain(self, institute):
-        domain = "%s.%s" % (institute, Config["domain"])
+    def __setstate__(self, state):
+        # share the group sets also between unpickled hosts
+        if isinstance(state, tuple):
+            state = state[1]
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.groups = intern_groups(self.groups)
+
+    def get_domain(self, institute, config: Optional[CompiledConfig]=None):
+        if config is None:
+            config = Config.compiled()
+        domain = "%s.%s" % (institute, config.domain)
         return domain
 
     def __repr__(self) -> str:
@@ -73,7 +164,7 @@ class Host:
         infos = [
             ("Hostname: ", self.fqdn),
             ("IP: ", str(self.ip) + " (nonunique)" if not self.vars['unique'] else self.ip),
-        ]
+        ]  # type: list
         if printmac:
             infos.append(("MAC: ", self.mac))
 
@@ -96,15 +187,19 @@ class Host:
     @property
     def aliases(self) -> List[str]:
         "Generate hostname aliases for DNS"
-        if self.prefix.startswith(self.vars['institute']):
-            return [self.fqdn, self.prefix, self.prefix[len(self.vars['institute']):]]
-        else:
-            return [self.fqdn, self.prefix]
+        if self._aliases is None:
+            if self.prefix.startswith(self.vars['institute']):
+                self._aliases = [self.fqdn, self.prefix, self.prefix[len(self.vars['institute']):]]
+            else:
+                self._aliases = [self.fqdn, self.prefix]
+        return self._aliases
 
 
 class YMLHost(Host):
     "Host generated from yml file entry"
 
+    __slots__ = ()
+
     _num = '(2[0-5]|1[0-9]|[0-9])?[0-9]'
     IPREGEXP = re.compile(r'^(' + _num + r'\.){3}(' + _num + ')$')
     MACREGEXP = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
@@ -113,25 +208,29 @@ class YMLHost(Host):
                  inputdata: dict,
                  hosttype: str,
                  institute: str,
-                 header: Optional[dict]=None
+                 header: Optional[dict]=None,
+                 config: Optional[CompiledConfig]=None,
+                 layer: Optional[Mapping]=None
                  ) -> None:
         """
         parses a config file line of the form
         #host=host1.abc.kit.edu        hwadress=00:12:34:ab:cd:ef      ipadress=127.0.0.1
-        """
-        self._set_defaults()
-        self.vars['hosttype'] = hosttype
-        self.vars['institute'] = institute
 
+        layer is the section_layer of the section, built if not given.
+        """
+        if config is None:
+            config = Config.compiled()
+        self._set_defaults(config)
+        # variables are looked up in the order host > header > filename
+        if layer is None:
+            layer = section_layer(header, hosttype, institute)
+        self.vars = LayeredVars(dict(inputdata), layer)
+
+        groups = set(self.groups)
         if header:
-            for var, value in header.items():
-                self.vars[var] = value
-            self.groups.update(header.get('groups', {}))
-            self.groups.difference_update(header.get('notgroups', {}))
-
-        for var, value in inputdata.items():
-            self.vars[var] = value
-        self.groups.update(inputdata.get('groups', {}))
+            groups.update(header.get('groups', {}))
+            groups.difference_update(header.get('notgroups', {}))
+        groups.update(inputdata.get('groups', {}))
 
         if 'hostname' not in self.vars:
             raise Exception("Entry without hostname.")
@@ -139,17 +238,18 @@ class YMLHost(Host):
 
         if not self.vars['institute']:
             raise Exception("No institute given for %s." % self.hostname)
-        self.groups.update({
+        groups.update({
             self.vars['hosttype'],
             self.vars['institute'],
             self.vars['institute'] + self.vars['hosttype']
         })
-        self.groups.difference_update(inputdata.get('notgroups', {}))
+        groups.difference_update(inputdata.get('notgroups', {}))
+        self.groups = intern_groups(groups)
 
         self._check_macip()
 
-        self._set_fqdn()
-        self._set_publicip()
+        self._set_fqdn(config)
+        self._set_publicip(config)
         if header and 'iprange' in header:
             self._check_iprange(header['iprange'])
         self.header = header
@@ -179,9 +279,12 @@ class YMLHost(Host):
             raise Exception("%s has IP %s outside of range %s-%s." %
                             (self.fqdn, self.ip, iprange[0], iprange[1]))
 
-    def run_checks(self) -> dict:
+    def run_checks(self, users: Optional[Dict[str, bool]]=None) -> dict:
+        """run the checks of this host
+
+        users tells which users exist, e.g. from UserResolver.resolve()"""
         checks = {
-                'user':  self._check_user(),
+                'user':  self._check_user(users),
                 'end_date': self._check_end_date()
                 }
         return checks
@@ -198,12 +301,13 @@ class YMLHost(Host):
                 return False
         return True
 
-    def _check_user(self) -> bool:
+    def _check_user(self, users: Optional[Dict[str, bool]]=None) -> bool:
         "Check that user (still) exists if set"
         if 'user' in self.vars:
-            try:
-                subprocess.check_output(['id', self.vars['user']])
-            except subprocess.CalledProcessError:
+            user = str(self.vars['user'])
+            if users is None or user not in users:
+                users = get_resolver(Config.compiled()).resolve([user])
+            if not users[user]:
                 logging.error("User %s does not exist and is listed for host %s." % (self.vars['user'], self.hostname))
                 return False
         return True
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+class HostIndex:
+    """Hash indexes of hosts by fqdn, ip, mac and hostname
+
+    All indexes are built in a single pass over the hosts and map each
+    key to the list of hosts having it, in hostlist order.
+    """
+
+    PROPS = ('fqdn', 'ip', 'mac', 'hostname')
+
+    def __init__(self, hosts: Iterable) -> None:
+        self.index = {prop: defaultdict(list) for prop in self.PROPS}  # type: Dict[str, Dict]
+        by_fqdn, by_ip, by_mac, by_hostname = (self.index[prop] for prop in self.PROPS)
+        for h in hosts:
+            by_fqdn[h.fqdn].append(h)
+            if h.ip is not None:
+                by_ip[h.ip].append(h)
+            if h.mac is not None:
+                by_mac[h.mac].append(h)
+            by_hostname[h.hostname].append(h)
+
+    def __getitem__(self, prop: str) -> Dict:
+        return self.index[prop]
+
+    def lookup(self, prop: str, key) -> List:
+        "hosts with the given key, without adding it to the index"
+        return self.index[prop].get(key, [])
+
+    def conflicts(self, prop: str) -> Iterator[Tuple[object, List]]:
+        "yield all keys of prop shared by more than one host with these hosts"
+        for key, hosts in self.index[prop].items():
+            if len(hosts) > 1:
+                yield key, hosts
@@ -2,28 +2,326 @@
 
 import logging
 import types
-from collections import defaultdict
 import os
 import sys
 import ipaddress
-import itertools
+import heapq
 import glob
+import functools
+import multiprocessing
 import yaml
-from typing import Dict, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from yaml.events import (StreamEndEvent, MappingStartEvent, MappingEndEvent,
+                         SequenceStartEvent, SequenceEndEvent)
 try:
     from yaml import CSafeLoader as SafeLoader # type: ignore
+    from yaml.cyaml import CParser # type: ignore
+
+    class StreamLoader(CParser, yaml.composer.Composer, yaml.constructor.SafeConstructor, yaml.resolver.Resolver): # type: ignore
+        "libyaml event parser that composes and constructs one node at a time"
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+            yaml.constructor.SafeConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
 except ImportError:
     from yaml import SafeLoader # type: ignore
+    StreamLoader = SafeLoader # type: ignore
 
 from . import host
-from .config import CONFIGINSTANCE as Config
+from .cache import ParseCache, file_digest
+from .checks import CheckRunner
+from .checkstate import CheckState, cnames_digest
+from .groupindex import GroupIndex
+from .hostindex import HostIndex
+from .query import Query
+from .users import get_resolver
+from .config import CONFIGINSTANCE as Config, CompiledConfig
+
+# both look up hosts by fqdn, ip, mac and hostname for the checks
+HostLookup = Union[HostIndex, CheckState]
+
+
+def _parse_filename(fname):
+    "get hosttype and institute from hostlists/hosttype-institute.yml"
+    shortname = os.path.splitext(os.path.basename(fname))[0]
+    if shortname.count('-') > 1:
+        logging.error('Filename %s contains to many dashes. Skipped.' % fname)
+        return None
+    if '-' in shortname:
+        # get abc, def from hostlists/abc-def.yml
+        hosttype, institute = shortname.split('-')
+    else:
+        hosttype = shortname
+        institute = None
+    return hosttype, institute
+
+
+def _parse_section(yamlout, fname, hosttype, institute, config):
+    "turn one yaml document of fname into its header and hosts"
+    for field in ('header', 'hosts'):
+        if field not in yamlout:
+            logging.error('missing field %s in %s' % (field, fname))
+
+    header = _prepare_header(yamlout['header'])
+    layer = host.section_layer(header, hosttype, institute)
+    hosts = [host.YMLHost(hostdata, hosttype, institute, header, config, layer)
+             for hostdata in yamlout["hosts"]]
+    _fix_docker_ports(hosts)
+    return header, hosts
+
+
+def _prepare_header(header):
+    if 'iprange' in header:
+        ipstart, ipend = header['iprange']
+        header['iprange'] = ipaddress.ip_address(ipstart), ipaddress.ip_address(ipend)
+    return header
+
+
+def _fix_docker_ports(hosts):
+    for h in hosts:
+        if 'docker' in h.vars and 'ports' in h.vars['docker']:
+            # prefix docker ports with container IP,
+            # copy as the docker dict can be shared via the header
+            h.vars['docker'] = dict(h.vars['docker'])
+            h.vars['docker']['ports'] = [
+                str(h.ip) + ':' + port for port in h.vars['docker']['ports']
+            ]
+
+
+def load_ymlhostfile(fname: str,
+                     cache: Optional[ParseCache]=None,
+                     config: Optional[CompiledConfig]=None
+                     ) -> Optional[List[Tuple[dict, List[host.YMLHost]]]]:
+    """parse all hosts in fname
+
+    returns a (header, hosts) tuple per yaml document or None if the file is skipped.
+    Unchanged files are taken from cache without parsing, if given."""
+
+    if config is None:
+        config = Config.compiled()
+
+    filenameinfo = _parse_filename(fname)
+    if filenameinfo is None:
+        return None
+    hosttype, institute = filenameinfo
+    try:
+        with open(fname, 'rb') as infile:
+            content = infile.read()
+    except:
+        logging.error('file %s not readable' % fname)
+        return None
+
+    if cache is not None:
+        key = cache.key(fname.encode() + b'\0' + content)
+        sections = cache.get(key)
+        if sections is not None:
+            logging.debug("Using cached %s" % fname)
+            return sections
+
+    try:
+        yamlsections = yaml.load_all(content, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        logging.error('file %s not correct yml' % fname)
+        logging.error(str(e))
+        return None
+
+    sections = [_parse_section(yamlout, fname, hosttype, institute, config)
+                for yamlout in yamlsections]
+    if cache is not None:
+        cache.put(key, sections)
+    return sections
+
+
+def iter_hosts(hostlistdir: Optional[str]=None,
+               config: Optional[CompiledConfig]=None) -> Iterator[host.YMLHost]:
+    """yield the hosts of all hostlist files in hostlistdir one at a time
+
+    The hosts are built from the yaml event stream entry by entry, so memory
+    stays constant for consumers that need only a single pass over the hosts."""
+
+    if config is None:
+        config = Config.compiled()
+    if hostlistdir is None:
+        hostlistdir = config.hostlistdir
+    for fname in sorted(glob.glob(hostlistdir + '/*.yml')):
+        filenameinfo = _parse_filename(fname)
+        if filenameinfo is None:
+            continue
+        hosttype, institute = filenameinfo
+        try:
+            infile = open(fname, 'rb')
+        except:
+            logging.error('file %s not readable' % fname)
+            continue
+        with infile:
+            yield from _iter_filehosts(infile, fname, hosttype, institute, config)
+
+
+def _iter_filehosts(infile, fname, hosttype, institute, config):
+    "build the hosts of all yaml documents in infile while parsing it"
+    loader = StreamLoader(infile)
+    try:
+        loader.get_event()  # stream start
+        while not loader.check_event(StreamEndEvent):
+            loader.get_event()  # document start
+            loader.anchors = {}
+            if not loader.check_event(MappingStartEvent):
+                loader.compose_node(None, None)
+                logging.error('missing field header in %s' % fname)
+                raise KeyError('header')
+
+            loader.get_event()
+            header = layer = None
+            has_hosts = False
+            pending = []  # host entries seen before the header
+            while not loader.check_event(MappingEndEvent):
+                key = loader.construct_document(loader.compose_node(None, None))
+                if key == 'hosts' and loader.check_event(SequenceStartEvent):
+                    has_hosts = True
+                    loader.get_event()
+                    while not loader.check_event(SequenceEndEvent):
+                        node = loader.compose_node(None, None)
+                        if header is None:
+                            pending.append(node)
+                            continue
+                        yield _build_host(loader.construct_document(node), hosttype, institute, header, config, layer)
+                    loader.get_event()
+                elif key == 'header':
+                    header = _prepare_header(loader.construct_document(loader.compose_node(None, None)))
+                    layer = host.section_layer(header, hosttype, institute)
+                    for node in pending:
+                        yield _build_host(loader.construct_document(node), hosttype, institute, header, config, layer)
+                    pending = []
+                else:
+                    loader.compose_node(None, None)
+            loader.get_event()
+
+            if not has_hosts:
+                logging.error('missing field hosts in %s' % fname)
+            if header is None:
+                logging.error('missing field header in %s' % fname)
+                raise KeyError('header')
+            loader.get_event()  # document end
+    finally:
+        loader.dispose()
+
+
+def _build_host(hostdata, hosttype, institute, header, config, layer):
+    newhost = host.YMLHost(hostdata, hosttype, institute, header, config, layer)
+    _fix_docker_ports([newhost])
+    return newhost
+
+
+def load_ymlhostfiles(fnames: List[str],
+                      jobs: int=1,
+                      cache: Optional[ParseCache]=None,
+                      config: Optional[CompiledConfig]=None) -> list:
+    """parse all fnames, in a pool of worker processes if jobs > 1
+
+    jobs=0 uses one process per CPU. The results are in the order of fnames.
+    The workers are started by a fork server, not forked from the caller,
+    which may have other threads holding locks, like the daemon."""
+
+    if config is None:
+        config = Config.compiled()
+    load = functools.partial(load_ymlhostfile, cache=cache, config=config)
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(fnames))
+    if jobs <= 1:
+        return [load(fname) for fname in fnames]
+
+    logging.debug("Parsing %s files with %s processes" % (len(fnames), jobs))
+    with multiprocessing.get_context('forkserver').Pool(jobs) as pool:
+        chunksize = max(1, len(fnames) // (4 * jobs))
+        return pool.map(load, fnames, chunksize=chunksize)
+
+
+def named_sections(fname: str, sections: list) -> Iterator[Tuple[str, dict, list]]:
+    "yield (name, header, hosts) of the sections parsed from fname"
+    for num, (header, hosts) in enumerate(sections, 1):
+        name = fname if len(sections) == 1 else '%s (document %s)' % (fname, num)
+        yield name, header, hosts
+
+
+def find_overlaps(ranges: Iterable[Tuple]) -> Iterator[Tuple]:
+    """find all overlapping (low, high, item) ranges in O(n log n + overlaps)
+
+    yields (overlap_low, overlap_high, item_a, item_b), where range a starts first"""
+
+    active = []  # type: list
+    for num, (low, high, item) in enumerate(sorted(ranges, key=lambda r: (r[0], r[1]))):
+        # ranges ending before this one starts cannot overlap any later range
+        while active and active[0][0] < low:
+            heapq.heappop(active)
+        for other_high, _, other in sorted(active, key=lambda a: a[1]):
+            yield low, min(high, other_high), other, item
+        heapq.heappush(active, (high, num, item))
 
 
 class Hostlist(list):
+    """list of hosts
+
+    groups indexes the members of each group and is kept up to date
+    when hosts are added or removed."""
 
-    def __init__(self):
+    def __init__(self, config: Optional[CompiledConfig]=None) -> None:
         super().__init__()
-        self.fileheaders = {}
+        self.fileheaders = {}  # type: Dict[str, dict]
+        self.config = config if config is not None else Config.compiled()
+        self.groups = GroupIndex()
+
+    def append(self, newhost) -> None:
+        # first, the index rejects hosts that are already in the list
+        self.groups.add(newhost)
+        super().append(newhost)
+
+    def extend(self, hosts) -> None:
+        for newhost in hosts:
+            self.append(newhost)
+
+    def __iadd__(self, hosts):  # type: ignore  # list.__add__ only takes lists
+        self.extend(hosts)
+        return self
+
+    def remove(self, oldhost) -> None:
+        super().remove(oldhost)
+        self.groups.remove(oldhost)
+
+    def pop(self, *args):
+        oldhost = super().pop(*args)
+        self.groups.remove(oldhost)
+        return oldhost
+
+    def clear(self) -> None:
+        super().clear()
+        self.groups = GroupIndex()
+
+    def _reindex(self) -> None:
+        "build the group index again, e.g. after the order of hosts changed"
+        self.groups = GroupIndex(self)
+
+    def insert(self, *args) -> None:
+        super().insert(*args)
+        self._reindex()
+
+    def __setitem__(self, *args) -> None:
+        super().__setitem__(*args)
+        self._reindex()
+
+    def __delitem__(self, *args) -> None:
+        super().__delitem__(*args)
+        self._reindex()
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._reindex()
 
     def __str__(self):
         return '\n'.join([str(h) for h in self])
@@ -51,83 +349,84 @@ class Hostlist(list):
 class DNSVSHostlist(Hostlist):
     "Hostlist filed from DNSVS"
 
-    def __init__(self, input: Dict[str, Tuple[str, bool]]) -> None:
-        super().__init__()
+    def __init__(self,
+                 input: Dict[str, Tuple[str, bool]],
+                 config: Optional[CompiledConfig]=None) -> None:
+        super().__init__(config)
         for hostname, data in input.items():
             ip, is_nonunique = data
-            self.append(host.Host(hostname, ip, is_nonunique))
+            self.append(host.Host(hostname, ip, is_nonunique, self.config))
 
 
 class YMLHostlist(Hostlist):
     "Hostlist filed from yml file"
 
-    def __init__(self):
-        super().__init__()
-        self.groups = defaultdict(list)
-        input_ymls = sorted(glob.glob(Config["hostlistdir"] + '/*.yml'))
+    def __init__(self,
+                 jobs: Optional[int]=None,
+                 use_cache: bool=True,
+                 config: Optional[CompiledConfig]=None,
+                 fnames: Optional[List[str]]=None) -> None:
+        "load fnames, all hostlist files in hostlistdir by default"
+        super().__init__(config)
+        self._files = {}  # type: Dict[str, list]
+        if fnames is None:
+            fnames = glob.glob(self.config.hostlistdir + '/*.yml')
+        input_ymls = sorted(fnames)
         logging.debug("Using %s" % ', '.join(input_ymls))
-        for inputfile in input_ymls:
-            self._add_ymlhostfile(inputfile)
+        if jobs is None:
+            jobs = self.config.get('jobs', 1)
+        cache = ParseCache.from_config(self.config) if use_cache else None
+        # digests before parsing, so a file changed meanwhile is checked again next time
+        self.digests = {os.path.basename(f): file_digest(f) for f in input_ymls}
+        for inputfile, sections in zip(input_ymls, load_ymlhostfiles(input_ymls, jobs, cache, self.config)):
+            self._add_sections(inputfile, sections)
+        if cache is not None:
+            cache.evict()
 
     def _add_ymlhostfile(self, fname):
         "parse all hosts in fname and add them to this hostlist"
+        self._add_sections(fname, load_ymlhostfile(fname, config=self.config))
 
-        shortname = os.path.splitext(os.path.basename(fname))[0]
-        if shortname.count('-') > 1:
-            logging.error('Filename %s contains to many dashes. Skipped.')
-            return
-        if '-' in shortname:
-            # get abc, def from hostlists/abc-def.yml
-            hosttype, institute = shortname.split('-')
-        else:
-            hosttype = shortname
-            institute = None
-        try:
-            infile = open(fname, 'r')
-        except:
-            logging.error('file %s not readable' % fname)
+    def _add_sections(self, fname, sections):
+        "add the (header, hosts) sections parsed from fname"
+        if sections is None:
             return
-
-        try:
-            yamlsections = yaml.load_all(infile, Loader=SafeLoader)
-        except yaml.YAMLError as e:
-            logging.error('file %s not correct yml' % fname)
-            logging.error(str(e))
-            return
-
-        for yamlout in yamlsections:
-            self._parse_section(yamlout, fname, hosttype, institute)
-
-        self._fix_docker_ports()
-
-    def _parse_section(self, yamlout, fname, hosttype, institute):
-        for field in ('header', 'hosts'):
-            if field not in yamlout:
-                logging.error('missing field %s in %s' % (field, fname))
-
-        header = yamlout['header']
-        if 'iprange' in header:
-            ipstart, ipend = header['iprange']
-            header['iprange'] = ipaddress.ip_address(ipstart), ipaddress.ip_address(ipend)
-        self.fileheaders[os.path.basename(fname)] = header
-
-        for hostdata in yamlout["hosts"]:
-            newhost = host.YMLHost(hostdata, hosttype, institute, header)
-            self.append(newhost)
-            for group in newhost.groups:
-                self.groups[group].append(newhost)
-
-    def _fix_docker_ports(self):
-        for h in self:
-            if 'docker' in h.vars and 'ports' in h.vars['docker']:
-                # prefix docker ports with container IP
-                h.vars['docker']['ports'] = [
-                    str(h.ip) + ':' + port for port in h.vars['docker']['ports']
-                ]
+        self._files[os.path.basename(fname)] = sections
+        for header, hosts in sections:
+            self.fileheaders[os.path.basename(fname)] = header
+            self.extend(hosts)
+
+    def updated(self, fnames: List[str], use_cache: bool=True) -> 'YMLHostlist':
+        """return a copy of this hostlist with fnames parsed again
+
+        fnames are the added, changed or removed files. All other files
+        are taken over from this hostlist without parsing them."""
+
+        present = sorted(f for f in fnames if os.path.isfile(f))
+        cache = ParseCache.from_config(self.config) if use_cache else None
+        digests = dict(self.digests)
+        digests.update((os.path.basename(f), file_digest(f)) for f in present)
+        # parse first, so a broken file leaves this hostlist untouched
+        parsed = dict(zip(map(os.path.basename, present), load_ymlhostfiles(present, 1, cache, self.config)))
+
+        files = dict(self._files)
+        for fname in fnames:
+            files.pop(os.path.basename(fname), None)
+        files.update((name, sections) for name, sections in parsed.items() if sections is not None)
+
+        new = self.__class__.__new__(self.__class__)
+        Hostlist.__init__(new, self.config)
+        new._files = {}
+        new.digests = {name: digests.get(name) for name in files}
+        for name in sorted(files):
+            new._add_sections(name, files[name])
+        return new
 
     def print(self, filter):
-        filtered = [h for h in self if h.filter(filter)]
-        for h in filtered:
+        "print the hosts matching filter, a Query or the terms of one"
+        if not isinstance(filter, Query):
+            filter = Query(filter)
+        for h in filter.select(self.groups):
             if logging.getLogger().level == logging.DEBUG:
                 print(h.output(printgroups=True, printallvars=True))
             elif logging.getLogger().level == logging.INFO:
@@ -135,129 +434,269 @@ class YMLHostlist(Hostlist):
             else:
                 print(h.hostname)
 
-    def check_consistency(self, cnames):
+    def check_consistency(self,
+                          cnames,
+                          report: Optional[str]=None,
+                          jobs: Optional[int]=None,
+                          incremental: bool=False,
+                          full: bool=False):
+        """run all checks and exit if one of them fails and is not ignored
+
+        The checks run concurrently in jobs threads. A json report with the
+        duration, number of examined hosts and failures of every check is
+        written to report, if given.
+        With incremental, the state of the last run that passed all checks
+        is kept and only what changed since then is checked, unless full is
+        set."""
+
+        checks, state = self._consistency_checks(cnames, incremental, full)
+        return self._run_checks(checks, state, report, jobs)
+
+    def check_changes(self,
+                      cnames,
+                      removed: Iterable[str]=(),
+                      report: Optional[str]=None,
+                      jobs: Optional[int]=None,
+                      use_cache: bool=True):
+        """check the files of this hostlist as changes of the hostlist in hostlistdir
+
+        This hostlist holds only the changed files, the removed ones are
+        given by name. The other files are only used as keys to check the
+        changes against: from the saved check state if their content is
+        unchanged, else from the parse cache or by parsing them.
+        Exits like check_consistency if a check fails."""
+
+        state = CheckState.from_config(self.config)
+        if state is None:
+            state = CheckState(None, self.config)
+        cache = ParseCache.from_config(self.config) if use_cache else None
+        # only save a state of which every file was checked
+        complete = not state.empty
+        removed = {os.path.basename(f) for f in removed}
+        others = sorted(f for f in glob.glob(self.config.hostlistdir + '/*.yml')
+                        if os.path.basename(f) not in self._files)
+        for fname in others:
+            name = os.path.basename(fname)
+            digest = file_digest(fname)
+            if digest is not None and state.digests.get(name) == digest:
+                continue
+            logging.debug("%s not in check state, loading it" % fname)
+            complete = False
+            sections = load_ymlhostfile(fname, cache, self.config)
+            if sections is None:
+                state.remove_file(name)
+            else:
+                state.set_file(name, digest, named_sections(name, sections))
+        for name in set(state.digests) - {os.path.basename(f) for f in others} - set(self._files) - removed:
+            state.remove_file(name)
+        state.reset_changes()
+
+        for name in removed:
+            state.remove_file(name)
+        for name, sections in self._files.items():
+            state.set_file(name, self.digests.get(name), named_sections(name, sections))
+        checks = self._incremental_checks(cnames, state)
+        return self._run_checks(checks, state if complete else None, report, jobs)
+
+    def _run_checks(self, checks: dict, state: Optional[CheckState], report: Optional[str], jobs: Optional[int]):
+        "run checks, save state if all of them pass, exit if one fails and is not ignored"
+        runner = CheckRunner(jobs)
+        results = runner.run(checks)
+        for check, result in results.items():
+            result.ignored = not result.success and check in self.config.ignore_checks
+
+        logging.info("consistency check finished")
+        if report:
+            runner.write_report(report)
+        if state is not None and all(result.success for result in results.values()):
+            state.save()
+        if not runner.success:
+            sys.exit(1)
+        return results
+
+    def _consistency_checks(self, cnames, incremental: bool=False, full: bool=False) -> Tuple[dict, Optional[CheckState]]:
+        """return all checks as name: (check, number of examined hosts)
+
+        and the state to save if all of them pass"""
+
+        state = CheckState.from_config(self.config) if incremental else None
+        # hosts added to the hostlist besides its files cannot be tracked
+        if state is not None and len(self) != sum(len(hosts) for sections in self._files.values() for _, hosts in sections):
+            logging.debug("Hostlist differs from its files, checking all hosts")
+            state = None
+        if state is not None and not (full or state.empty or state.cnames is None):
+            state.sync(self._files, self.digests, named_sections)
+            return self._incremental_checks(cnames, state), state
+
+        index = HostIndex(self)
+        userhosts = [h for h in self if 'user' in h.vars]
         checks = {
-                'nonunique': self.check_nonunique(),
-                'cnames': self.check_cnames(cnames),
-                'duplicates': self.check_duplicates(),
-                'missing_mac_ip': self.check_missing_mac_ip(),
+                'nonunique': (lambda: self.check_nonunique(index), len(self)),
+                'cnames': (lambda: self.check_cnames(cnames, index), len(self)),
+                'duplicates': (lambda: self.check_duplicates(index), len(self)),
+                'missing_mac_ip': (self.check_missing_mac_ip, len(self)),
+                'user': (lambda: self.check_users(userhosts), len(userhosts)),
+                'end_date': (self.check_end_dates, len(self)),
+                'iprange_overlap': (self.check_iprange_overlap, len(self)),
+                }
+        if state is not None:
+            state = CheckState(state.fname, self.config)
+            state.sync(self._files, self.digests, named_sections)
+            state.cnames = cnames_digest(cnames)
+        return checks, state
+
+    def _incremental_checks(self, cnames, state: CheckState) -> dict:
+        """return the checks of the files changed in state
+
+        Only the hosts of changed files and the keys and ipranges they touch
+        are checked against the index in state. user and end_date depend on
+        the time, so they still check all hosts of this hostlist."""
+
+        logging.info("checking %s changed files" % len(state.changed))
+        hosts = [h for fname in sorted(state.changed) for _, filehosts in self._files.get(fname, []) for h in filehosts]
+        touched = state.touched_sections()
+        newcnames = cnames_digest(cnames)
+        if state.cnames != newcnames:
+            state.cnames = newcnames
+        else:
+            fqdns = state.touched['fqdn']
+            cnames = [c for c in cnames if c.fqdn in fqdns or c.dest in fqdns]
+        groups = GroupIndex(hosts)
+        userhosts = [h for h in self if 'user' in h.vars]
+        return {
+                'nonunique': (lambda: self.check_nonunique(state, hosts), len(hosts)),
+                'cnames': (lambda: self.check_cnames(cnames, state), len(cnames)),
+                'duplicates': (lambda: self.check_duplicates(state), len(hosts)),
+                'missing_mac_ip': (lambda: self.check_missing_mac_ip(groups), len(hosts)),
+                'user': (lambda: self.check_users(userhosts), len(userhosts)),
+                'end_date': (self.check_end_dates, len(self)),
+                'iprange_overlap': (lambda: self.check_iprange_overlap(state.sections(), touched), len(hosts)),
                 }
-        for h in self:
-            for hcheck,hstatus in h.run_checks().items():
-                if not hstatus:
-                    checks.update({hcheck:hstatus})
 
-        if isinstance(self, YMLHostlist):
-            checks.update({'iprange_overlap': self.check_iprange_overlap()})
+    def check_users(self, hosts: Optional[list]=None) -> bool:
+        """check that the users set for hosts exist"""
+        if hosts is None:
+            hosts = [h for h in self if 'user' in h.vars]
+        users = get_resolver(self.config).resolve({h.vars['user'] for h in hosts})
+        results = [h._check_user(users) for h in hosts]
+        return all(results)
 
-        logging.info("consistency check finished")
-        for check,status in checks.items():
-            if not status and not ('ignore_checks' in Config and
-                        check in Config["ignore_checks"]):
-                sys.exit(1)
+    def check_end_dates(self) -> bool:
+        """check that no end_date is over"""
+        results = [h._check_end_date() for h in self]
+        return all(results)
 
-    def check_nonunique(self):
+    def check_nonunique(self, index: Optional[HostLookup]=None, hosts: Optional[list]=None):
         """ensure nonunique flag agrees with nonunique_ips config"""
+        if index is None:
+            index = HostIndex(self)
+        if hosts is None:
+            hosts = self
         success = True
-        nonunique_ips = defaultdict(list)
-        for h in self:
-            ip_fit = str(h.ip) in Config["nonunique_ips"]
-            if ip_fit and h.vars['unique']:
-                nonunique_ips[str(h.ip)].append(h)
-            if not ip_fit and not h.vars['unique']:
+        for h in hosts:
+            if not h.vars['unique'] and str(h.ip) not in self.config.nonunique_ips:
                 logging.error("Host %s has nonunique ip flag, "
                               "but its ip is not listed in the config." % h)
                 success = False
 
-        for ip in nonunique_ips:
-            if len(nonunique_ips[ip]) > 1:
+        for ip, iphosts in index.conflicts('ip'):
+            if str(ip) not in self.config.nonunique_ips:
+                continue
+            flagged = [h for h in iphosts if h.vars['unique']]
+            if len(flagged) > 1:
                 logging.error("More than one host uses a given nonunique ip"
                               " without being flagged:\n" +
-                              ('\n'.join((str(x) for x in nonunique_ips[ip]))))
+                              ('\n'.join((str(x) for x in flagged))))
                 success = False
 
         return success
 
-    def check_cnames(self, cnames):
+    def check_cnames(self, cnames, index: Optional[HostLookup]=None):
         """ensure there are no duplicates between hostlist and cnames"""
+        if index is None:
+            index = HostIndex(self)
         success = True
         for cname in cnames:
-            has_dest = False
-            for h in self:
-                if h.fqdn == cname.fqdn:
-                    logging.error("%s conflicts with %s." % (cname, h))
-                    success = False
-                if cname.dest == h.fqdn:
-                    has_dest = True
-            if not has_dest:
+            for h in index.lookup('fqdn', cname.fqdn):
+                logging.error("%s conflicts with %s." % (cname, h))
+                success = False
+            if not index.lookup('fqdn', cname.dest):
                 logging.error("%s points to a non-existing host." % cname)
                 success = False
         return success
 
-    def check_duplicates(self):
+    def check_duplicates(self, index: Optional[HostLookup]=None):
         """check consistency of hostlist
 
         detect duplicates (ip, mac, hostname)"""
 
+        if index is None:
+            index = HostIndex(self)
         success = True
-        inverselist = {}
-        tocheck_props = ['ip', 'mac', 'hostname']
-        for prop in tocheck_props:
-            inverselist[prop] = {}
-            for h in self:
-                myhostprop = getattr(h, prop)
-                if myhostprop is None:
-                    continue
-                if prop == 'ip' and str(myhostprop) in Config["nonunique_ips"]:
+        for prop in ['ip', 'mac', 'hostname']:
+            for key, hosts in index.conflicts(prop):
+                if prop == 'ip' and str(key) in self.config.nonunique_ips:
                     # allow nonunique ips if listed in config
                     continue
-                if myhostprop in inverselist[prop]:
-                    logging.error("Found duplicate %s for hosts \n%s\n%s"
-                                  % (prop, inverselist[prop][myhostprop], h))
-                    success = False
-                inverselist[prop][myhostprop] = h
+                logging.error("Found duplicate %s for hosts \n%s"
+                              % (prop, '\n'.join(str(h) for h in hosts)))
+                success = False
         return success
 
-    def check_missing_mac_ip(self) -> bool:
+    def check_missing_mac_ip(self, groups: Optional[GroupIndex]=None) -> bool:
         """check if hosts are missing an ip or mac"""
 
+        if groups is None:
+            groups = self.groups
         success = True
-        for h in self:
-            if 'needs_ip' in h.groups and h.ip is None:
+        for h in groups['needs_ip']:
+            if h.ip is None:
                 logging.error("Missing IP in %s ", h)
                 success = False
 
         if isinstance(self, YMLHostlist):
-            for h in self:
-                if 'needs_mac' in h.groups and h.mac is None:
+            for h in groups['needs_mac']:
+                if h.mac is None:
                     logging.error("Missing MAC in %s ", h)
                     success = False
         return success
 
-    def check_iprange_overlap(self) -> bool:
-        "check whether any of the ipranges given in headers overlap"
-
-        overlaps = []
-        for ita, itb in itertools.combinations(self.fileheaders.items(), 2):
-            filea, headera = ita
-            fileb, headerb = itb
-            try:
-                a = headera['iprange']
-                b = headerb['iprange']
-            except KeyError:
-                # one of the files does not have iprange defined, ignore it
+    def sections(self) -> Iterator[Tuple[str, dict, list]]:
+        "yield (name, header, hosts) of all yaml documents in filename order"
+        for fname, sections in self._files.items():
+            yield from named_sections(fname, sections)
+
+    def check_iprange_overlap(self,
+                              sections: Optional[Iterable[Tuple[str, dict, list]]]=None,
+                              touched: Optional[set]=None) -> bool:
+        """check whether any of the ipranges given in headers overlap
+
+        If one of two overlapping sections sets iprange_allow_overlap,
+        its hosts must still not use IPs of the range of the other one.
+        If touched is given, only overlaps with these sections are checked."""
+
+        if sections is None:
+            sections = self.sections()
+        ranges = [(header['iprange'][0], header['iprange'][1], (name, header, hosts))
+                  for name, header, hosts in sections
+                  if 'iprange' in header]
+        success = True
+        for low, high, a, b in find_overlaps(ranges):
+            namea, headera, hostsa = a
+            nameb, headerb, hostsb = b
+            if touched is not None and namea not in touched and nameb not in touched:
                 continue
-            if headera.get('iprange_allow_overlap', False) or \
-               headerb.get('iprange_allow_overlap', False):
-                # FIXME: check overlap for internal IPs
+            allowa = headera.get('iprange_allow_overlap', False)
+            allowb = headerb.get('iprange_allow_overlap', False)
+            if not allowa and not allowb:
+                logging.error("Found overlap from %s to %s in files %s and %s." % (low, high, namea, nameb))
+                success = False
                 continue
-
-            # check if there is overlap between a and b
-            overlap_low = max(a[0], b[0])
-            overlap_high = min(a[1], b[1])
-            if overlap_low <= overlap_high:
-                overlaps.append((overlap_low, overlap_high, filea, fileb))
-        if overlaps:
-            for overlap in overlaps:
-                logging.error("Found overlap from %s to %s in files %s and %s." % overlap)
-        return not bool(overlaps)
+            for allowed, hosts, name, other in ((allowa, hostsa, namea, nameb), (allowb, hostsb, nameb, namea)):
+                if not allowed or (allowa and allowb):
+                    continue
+                for h in hosts:
+                    if h.ip is not None and h.ip.version == low.version and low <= h.ip <= high:
+                        logging.error("Host %s from %s uses an IP in the iprange of %s." % (h, name, other))
+                        success = False
+        return success
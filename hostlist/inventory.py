@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dbm
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from . import hostlist
+from .cnamelist import CNamelist
+from .cache import atomic_write, get_cachedir
+from .config import CONFIGINSTANCE as Config, CompiledConfig
+from .output_services import ansible
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+def parse_args() -> argparse.Namespace:
+    "setup parser for script arguments"
+    parser = argparse.ArgumentParser(
+        description='ansible dynamic inventory of the hostlist',
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--list',
+                       action='store_true',
+                       help='print the inventory as json')
+    group.add_argument('--host',
+                       metavar='HOST',
+                       help='print the variables of HOST as json')
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='build the inventory again, even if no hostlist file changed')
+    return parser.parse_args()
+
+
+def dumps(data) -> bytes:
+    """compact json, with orjson if available
+
+    Values json has no type for are written as their str, like the ansible output does."""
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, separators=(',', ':'), default=str).encode()
+
+
+def state_key(config: CompiledConfig) -> str:
+    "identifies the config and hostlist files by their path, size, mtime and inode"
+    fnames = [Config.CONFIGNAME] + sorted(glob.glob(config.hostlistdir + '/*.yml'))
+    stats = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        stats.append('%s %s %s %s' % (fname, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+    return hashlib.sha256('\n'.join(stats).encode()).hexdigest()[:32]
+
+
+class InventoryCache:
+    """The rendered inventory of one state of the hostlist
+
+    --list is answered from <key>.json, --host from the dbm <key>.hostvars
+    of the json encoded variables of each host. The json file is written
+    last, so it tells that the inventory of key is complete.
+    """
+
+    def __init__(self, cachedir: str, key: str) -> None:
+        self.dir = os.path.join(cachedir, 'inventory')
+        os.makedirs(self.dir, exist_ok=True)
+        self.key = key
+        self.listfile = os.path.join(self.dir, key + '.json')
+        self.hostvarsfile = os.path.join(self.dir, key + '.hostvars')
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(os.path.join(self.dir, 'lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    @property
+    def complete(self) -> bool:
+        return os.path.exists(self.listfile)
+
+    def build(self, inventory: dict) -> None:
+        "store inventory and remove the ones of other keys"
+        with dbm.open(self.hostvarsfile, 'n') as hostvars:
+            for name, hvars in inventory['_meta']['hostvars'].items():
+                hostvars[name] = dumps(hvars)
+        atomic_write(self.listfile, dumps(inventory))
+        for entry in os.scandir(self.dir):
+            if not entry.name.startswith(self.key) and entry.name != 'lock':
+                os.unlink(entry.path)
+
+    def list(self) -> bytes:
+        with open(self.listfile, 'rb') as listfile:
+            return listfile.read()
+
+    def host(self, name: str) -> bytes:
+        with dbm.open(self.hostvarsfile, 'r') as hostvars:
+            return hostvars.get(name, b'{}')
+
+
+def render(config: CompiledConfig) -> dict:
+    "load the hostlist and render its inventory"
+    file_hostlist = hostlist.YMLHostlist(config=config)
+    return ansible._gen_inventory_dict(file_hostlist, CNamelist())
+
+
+def main():
+    "main routine"
+
+    logging.basicConfig(format='%(levelname)s:%(message)s')
+    logging.getLogger().setLevel(logging.ERROR)
+    args = parse_args()
+
+    if not Config.load():
+        logging.error("Need %s file to run." % Config.CONFIGNAME)
+        sys.exit(1)
+    config = Config.compiled()
+
+    cachedir = get_cachedir(config)
+    if cachedir is None:
+        inventory = render(config)
+        if args.list:
+            out = dumps(inventory)
+        else:
+            out = dumps(inventory['_meta']['hostvars'].get(args.host, {}))
+    else:
+        cache = InventoryCache(cachedir, state_key(config))
+        with cache.lock():
+            if args.refresh or not cache.complete:
+                cache.build(render(config))
+            out = cache.list() if args.list else cache.host(args.host)
+    sys.stdout.buffer.write(out + b'\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+from typing import Iterable, Iterator, Optional, Tuple
+
+from .cache import atomic_write
+
+# bump whenever the layout of the saved manifest changes
+FORMAT_VERSION = 1
+
+
+def fingerprint(text: str) -> str:
+    return hashlib.sha256(text.encode('utf8')).hexdigest()[:16]
+
+
+class Manifest:
+    """Fingerprints of the entries of one service output
+
+    Records the entries while the output is written. Given the manifest of
+    the previous output, it also collects the texts of the added and changed
+    entries, so a delta against the previous output can be made.
+    """
+
+    def __init__(self, previous: Optional['Manifest']=None) -> None:
+        self.output = None  # type: Optional[str]
+        self.entries = {}  # type: dict
+        self.previous = previous
+        self.added = {}  # type: dict
+        self.changed = {}  # type: dict
+
+    @classmethod
+    def load(cls, fname: str) -> Optional['Manifest']:
+        "the manifest saved in fname, None if there is none"
+        try:
+            with open(fname) as infile:
+                data = json.load(infile)
+            if data['version'] == FORMAT_VERSION:
+                manifest = cls()
+                manifest.output = data['output']
+                manifest.entries = data['entries']
+                return manifest
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Ignoring broken manifest %s: %s" % (fname, e))
+        return None
+
+    def save(self, fname: str) -> None:
+        data = {'version': FORMAT_VERSION, 'output': self.output, 'entries': self.entries}
+        atomic_write(fname, json.dumps(data, separators=(',', ':')).encode())
+
+    def record(self, entries: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+        "pass on the (key, text) entries of the output, recording their fingerprints"
+        for key, text in entries:
+            if key in self.entries:
+                # the checks forbid duplicates, unless they are ignored
+                number = 2
+                while '%s#%d' % (key, number) in self.entries:
+                    number += 1
+                key = '%s#%d' % (key, number)
+            digest = self.entries[key] = fingerprint(text)
+            if self.previous is not None:
+                before = self.previous.entries.get(key)
+                if before is None:
+                    self.added[key] = text
+                elif before != digest:
+                    self.changed[key] = text
+            yield key, text
+
+    def delta(self, service: str) -> dict:
+        """the changes since the previous manifest, which must be given
+
+        from and to are the sha256 of the previous and this output."""
+
+        previous = self.previous
+        if previous is None:
+            raise Exception("A delta needs the previous manifest.")
+        return {
+            'service': service,
+            'from': previous.output,
+            'to': self.output,
+            'added': self.added,
+            'changed': self.changed,
+            'removed': sorted(set(previous.entries) - set(self.entries)),
+        }
@@ -1,76 +1,162 @@
 #!/usr/bin/env python3
 
 from collections import defaultdict
+import hashlib
 import os
 import logging
 import ansiblecmdb
 import ansiblecmdb.render as render
 import json
+import itertools
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from .host import Host
 from .hostlist import Hostlist
 from .cnamelist import CNamelist
-from .config import CONFIGINSTANCE as Config
+from .config import CONFIGINSTANCE as Config, CompiledConfig
 
 Output_Services = {} # type: dict
+Output_Classes = {} # type: dict
 
 class Output_Register(type):
     def __new__(cls, clsname, bases, attrs):
         newcls = super(Output_Register, cls).__new__(cls, clsname, bases, attrs)
-        if hasattr(newcls, 'gen_content'):
+        if bases:
+            defined = {name for base in newcls.__mro__[:-2] for name in vars(base)}
+            if newcls.has_entries and 'iter_entries' not in defined:
+                raise Exception("Service %s has entries, but no iter_entries." % clsname)
+            # the defaults of Output call each other
+            if not newcls.has_entries and not defined & {'gen_content', 'iter_content'}:
+                raise Exception("Service %s implements neither gen_content nor iter_content." % clsname)
             Output_Services.update({clsname: newcls.gen_content})
+            Output_Classes.update({clsname: newcls})
         return newcls
 
 class Output(metaclass=Output_Register):
-    pass
+    """Base of all services
+
+    Services implement either gen_content, returning the whole output,
+    or iter_content, yielding it in chunks. Services whose output is made
+    of one entry per host implement iter_entries instead, so buildfiles can
+    record a manifest of the entries and output only the changed ones."""
+
+    # True if gen_content only needs one pass over the hosts,
+    # so it can also be given an iterator like hostlist.iter_hosts()
+    single_pass = False
+    # approximate size of the chunks yielded by iter_content
+    chunksize = 1 << 16
+    # True if the daemon may serve the previous output while rendering a new one
+    stale_ok = False
+    # True if the output is made of entries: iter_entries(hostlist, cnames) yields
+    # (key, text) of each entry, the key is unique per host
+    has_entries = False
+
+    @classmethod
+    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
+        return ''.join(cls.iter_content(hostlist, cnames))
+
+    @classmethod
+    def iter_content(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[str]:
+        "yield the output in chunks"
+        if cls.has_entries:
+            # iter_entries is only defined by services with entries
+            yield from cls.content_of(cls.iter_entries(hostlist, cnames))  # type: ignore
+        else:
+            yield cls.gen_content(hostlist, cnames)
+
+    @classmethod
+    def _join(cls, texts: Iterable[str]) -> Iterator[str]:
+        "the output from the texts of the entries"
+        return cls._lines(texts)
+
+    @classmethod
+    def content_of(cls, entries: Iterable[Tuple[str, str]]) -> Iterator[str]:
+        "yield the output in chunks, made from the given entries"
+        return cls._chunks(cls._join(text for key, text in entries))
+
+    @classmethod
+    def _chunks(cls, parts: Iterable[str]) -> Iterator[str]:
+        "join small parts to chunks of about chunksize characters"
+        chunk, size = [], 0
+        for part in parts:
+            chunk.append(part)
+            size += len(part)
+            if size >= cls.chunksize:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk)
+
+    @classmethod
+    def inputs_version(cls, config: CompiledConfig) -> Optional[str]:
+        """identifies the state of the inputs other than hosts and cnames
+
+        None if there are none. The daemon renders the output again when it changes."""
+        return None
+
+    @staticmethod
+    def _members(hostlist, group: str) -> Iterable[Host]:
+        "hosts of hostlist in group, from its group index if it has one"
+        groups = getattr(hostlist, 'groups', None)
+        if groups is not None:
+            return groups[group]
+        return (h for h in hostlist if group in h.groups)
+
+    @staticmethod
+    def _lines(lines: Iterable[str]) -> Iterator[str]:
+        "yield lines with newlines between them, like '\\n'.join(lines)"
+        lines = iter(lines)
+        for line in lines:
+            yield line
+            break
+        for line in lines:
+            yield '\n'
+            yield line
+
+    @staticmethod
+    def _config(hostlist) -> CompiledConfig:
+        "config the hostlist was loaded with"
+        config = getattr(hostlist, 'config', None)
+        return config if config is not None else Config.compiled()
 
 class ssh_known_hosts(Output):
     "Generate hostlist for ssh-keyscan"
 
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
+    def iter_content(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[str]:
         # only scan keys on hosts that are in ansible
-        scan_hosts = [
-            h for h in hostlist
-            if 'ssh_known_hosts' in h.groups
-        ]
-        aliases = [alias
-                   for host in scan_hosts
-                   for alias in host.aliases
-                   if host.ip]
-        aliases += [str(host.ip)
-                    for host in scan_hosts
-                    if host.ip]
-        aliases += [cname.fqdn for cname in cnames]
-
-        fcont = '\n'.join(aliases)
-
-        return fcont
+        scan_hosts = [h for h in cls._members(hostlist, 'ssh_known_hosts') if h.ip]
+        aliases = itertools.chain(
+            (alias for host in scan_hosts for alias in host.aliases),
+            (str(host.ip) for host in scan_hosts),
+            (cname.fqdn for cname in cnames),
+        )
+        return cls._chunks(cls._lines(aliases))
 
 
 class hosts(Output):
     "Config output for /etc/hosts format"
+    single_pass = True
+    has_entries = True
 
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
-        hoststrings = (str(h.ip) + " " + " ".join(h.aliases) for h in hostlist if h.ip)
-        content = '\n'.join(hoststrings)
-        return content
+    def iter_entries(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[Tuple[str, str]]:
+        return ((h.fqdn, str(h.ip) + " " + " ".join(h.aliases)) for h in hostlist if h.ip)
 
 
 class munin(Output):
     "Config output for Munin"
+    has_entries = True
 
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
-        hostnames = (
-            h for h in hostlist
-            if 'muninnode' in h.groups
-        )
-        fcont = ''
-        for host in hostnames:
-            fcont += cls._get_hostblock(host)
-        return fcont
+    def iter_entries(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[Tuple[str, str]]:
+        return ((host.fqdn, cls._get_hostblock(host)) for host in cls._members(hostlist, 'muninnode'))
+
+    @classmethod
+    def _join(cls, texts: Iterable[str]) -> Iterator[str]:
+        # host blocks end with a newline
+        return iter(texts)
 
     @staticmethod
     def _get_hostblock(host: Host) -> str:
@@ -79,23 +165,22 @@ class munin(Output):
             institute=host.vars['institute'],
             hosttype=host.vars['hosttype'],
         )
-        for line in host.vars.get('munin', []):
-            cont += line + '\n'
-        return cont
+        return cont + ''.join(line + '\n' for line in host.vars.get('munin', []))
 
 
 class dhcp(Output):
     "DHCP config output"
+    single_pass = True
+    has_entries = True
 
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
-        out = ""
-        for host in hostlist:
-            entry = cls._gen_hostline(host)
-            if not entry:
-                continue
-            out += entry + '\n'
-        return out
+    def iter_entries(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[Tuple[str, str]]:
+        entries = ((host.fqdn, cls._gen_hostline(host)) for host in hostlist)
+        return ((key, entry) for key, entry in entries if entry)
+
+    @classmethod
+    def _join(cls, texts: Iterable[str]) -> Iterator[str]:
+        return (text + '\n' for text in texts)
 
     @staticmethod
     def _gen_hostline(host: Host) -> str:
@@ -113,11 +198,17 @@ class dhcp(Output):
 class ansible(Output):
     "Ansible inventory output"
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
-        return cls._gen_inventory(hostlist, cnames)
+    def iter_content(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[str]:
+        # dates and other values json has no type for are written as their str
+        encoder = json.JSONEncoder(indent=2, default=str)
+        return cls._chunks(encoder.iterencode(cls._gen_inventory_dict(hostlist, cnames)))
 
     @classmethod
     def _gen_inventory(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
+        return json.dumps(cls._gen_inventory_dict(hostlist, cnames), indent=2, default=str)
+
+    @classmethod
+    def _gen_inventory_dict(cls, hostlist: Hostlist, cnames: CNamelist) -> dict:
         """generate json inventory for ansible
         form:
             {
@@ -139,20 +230,20 @@ class ansible(Output):
         """
         resultdict = defaultdict(lambda: {'hosts': []})  # type: dict
         #  with python>=3.6 # type: defaultdict[str, Any]
+        config = cls._config(hostlist)
         hostvars = {}
         docker_services = {}
-        for host in hostlist:
-            # online add hosts that have ansible=yes
-            if 'ansible' not in host.groups:
-                continue
-            ans = cls._gen_host_content(host)
+        # only add hosts that have ansible=yes
+        for host in cls._members(hostlist, 'ansible'):
+            ans = cls._gen_host_content(host, config)
             hostvars[ans['fqdn']] = ans['vars']
             for groupname in ans['groups']:
                 resultdict[groupname]['hosts'] += [ans['fqdn']]
 
             if ans['vars']['hosttype'] == 'docker':
                 resultdict['dockerhost_' + host.hostname]['hosts'] += [ans['vars']['docker']['host']]
-                docker_services[host.hostname] = ans['vars']['docker']
+                # copy, the docker settings can be shared with other hosts via the header
+                docker_services[host.hostname] = dict(ans['vars']['docker'])
                 docker_services[host.hostname]['fqdn'] = host.fqdn
                 docker_services[host.hostname]['ip'] = str(host.ip)
 
@@ -160,10 +251,10 @@ class ansible(Output):
         if docker_services:
             resultdict['vserverhost']['vars'] = {'docker_services': docker_services}
 
-        return json.dumps(resultdict,indent=2)
+        return resultdict
 
     @staticmethod
-    def _gen_host_content(host):
+    def _gen_host_content(host, config):
         "Generate output for one host"
 
         result = {
@@ -174,17 +265,80 @@ class ansible(Output):
         if host.ip:
             result['vars']['ip'] = str(host.ip)
 
-        ansiblevars = Config.get('ansiblevars', []) + ['hosttype', 'institute', 'docker']
-        for avar in ansiblevars:
+        for avar in config.ansiblevars:
             if avar in host.vars:
                 result['vars'][avar] = host.vars[avar]
         return result
 
 class cmdb(ansible):
     "Use ansible-cmdb to create webpages from inventory"
+    stale_ok = True
+
+    # parsed fact files by fact dir and name with the (mtime, size) they were read at
+    _facts = {}  # type: dict
+    _facts_lock = threading.Lock()
+
+    @classmethod
+    def iter_content(cls, hostlist, cnames):
+        yield cls.gen_content(hostlist, cnames)
+
+    @classmethod
+    def inputs_version(cls, config: CompiledConfig) -> str:
+        "digest of the names, mtimes and sizes of the fact files"
+        digest = hashlib.sha256()
+        for fact_dir in config.get('ansible_cmdb', {}).get('fact_dirs', []):
+            digest.update(('%s\n' % fact_dir).encode())
+            try:
+                entries = sorted(os.scandir(fact_dir), key=lambda entry: entry.name)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                digest.update(('%s %s %s\n' % (entry.name, stat.st_mtime_ns, stat.st_size)).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def _read_fact_dir(cls, fact_dir: str) -> List[Tuple[str, dict]]:
+        """return (hostname, facts) of all fact files in fact_dir
+
+        like ansiblecmdb.Ansible._parse_fact_dir, but only files changed
+        since the last call are read and parsed again"""
+
+        if not os.path.isdir(fact_dir):
+            raise IOError("Not a directory: '{0}'".format(fact_dir))
+        facts = []
+        with cls._facts_lock:
+            known = cls._facts.get(fact_dir, {})
+            # only the files still there, so removed ones are forgotten
+            current = {}
+            for fname in next(os.walk(fact_dir))[2]:
+                if fname.startswith('.'):
+                    continue
+                path = os.path.join(fact_dir, fname)
+                stat = os.stat(path)
+                version = (stat.st_mtime_ns, stat.st_size)
+                cached = known.get(fname)
+                if cached is None or cached[0] != version:
+                    logging.debug("Reading host facts from %s" % path)
+                    with open(path, encoding='utf8') as factfile:
+                        try:
+                            parsed = json.load(factfile)
+                        except ValueError as e:
+                            # Ignore non-JSON files
+                            logging.warning("Error parsing: %s: %s" % (fname, e))
+                            parsed = None
+                    cached = (version, parsed)
+                current[fname] = cached
+                if cached[1] is not None:
+                    facts.append((fname, cached[1]))
+            cls._facts[fact_dir] = current
+        return facts
+
     @classmethod
     def gen_content(cls, hostlist, cnames):
-        conf = Config.get('ansible_cmdb', {})
+        conf = cls._config(hostlist).get('ansible_cmdb', {})
         data_dir = conf.get('data_dir', '/usr/lib/ansiblecmdb/data')
         tpl_dir = os.path.join(data_dir, 'tpl')
         tpl = conf.get('template', 'html_fancy')
@@ -197,12 +351,20 @@ class cmdb(ansible):
         json_inventory = cls._gen_inventory(hostlist,cnames)
         # use cmdb parser to parse it
         inventory_parsed = ansiblecmdb.DynInvParser(json_inventory)
-        # add hosts to cmdb 'database', also load previously generated facts
-        cmdb = ansiblecmdb.Ansible(fact_dirs=fact_dirs)
+        # add hosts to cmdb 'database', also load previously generated facts,
+        # in the same order as ansiblecmdb would parse the fact dirs:
+        # as setup module output, then the inventory, then as fact cache
+        cmdb = ansiblecmdb.Ansible(fact_dirs=[])
+        cmdb.fact_dirs = fact_dirs
+        facts = [fact for fact_dir in fact_dirs for fact in cls._read_fact_dir(fact_dir)]
+        for hostname, hostfacts in facts:
+            cmdb.update_host(hostname, hostfacts)
+            cmdb.update_host(hostname, {'name': hostname})
         for host,hostvars in inventory_parsed.hosts.items():
             cmdb.update_host(host,hostvars)
-        for fact_dir in fact_dirs:
-            cmdb._parse_fact_dir(fact_dir, fact_cache=True)
+        for hostname, hostfacts in facts:
+            cmdb.update_host(hostname, {'ansible_facts': hostfacts})
+            cmdb.update_host(hostname, {'name': hostname})
         # run the cmdb render
         renderer = render.Render(tpl, ['.', tpl_dir])
         params = {
@@ -219,14 +381,13 @@ class cmdb(ansible):
 
 class ethers(Output):
     "/etc/ethers format output"
+    single_pass = True
+    has_entries = True
 
     @classmethod
-    def gen_content(cls, hostlist: Hostlist, cnames: CNamelist) -> str:
-        entries = (
-            "%s %s" % (h.mac, alias)
+    def iter_entries(cls, hostlist: Hostlist, cnames: CNamelist) -> Iterator[Tuple[str, str]]:
+        return (
+            (h.fqdn, '\n'.join("%s %s" % (h.mac, alias) for alias in h.aliases))
             for h in hostlist
-            for alias in h.aliases
-            if h.mac
+            if h.mac and h.aliases
         )
-        out = '\n'.join(entries)
-        return out
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import functools
+import operator
+import re
+from typing import Callable, Iterable, List, Union
+
+from .groupindex import GroupIndex
+
+_TOKEN = re.compile(r'[()]|[^\s()]+')
+KEYWORDS = ('AND', 'OR', 'NOT', '(', ')')
+
+# a compiled (sub)query, maps a group index to the bitset of the selected hosts
+Selector = Callable[[GroupIndex], int]
+
+
+class Query:
+    """A host filter compiled once to bitset operations on a GroupIndex
+
+    Terms are group names or hostnames, var=value for hosts with that variable
+    and !term for hosts not matching term. They are combined with NOT, AND, OR
+    (in this order of precedence) and parentheses, e.g.
+    ``server AND NOT (retired OR institute=def)``.
+    Without keywords the terms are a list like the one buildfiles always took:
+    hosts matching any term without ! and none of the terms with !.
+    """
+
+    def __init__(self, terms: Union[str, Iterable[str]]) -> None:
+        if isinstance(terms, str):
+            terms = [terms]
+        tokens = [token for term in terms for token in _TOKEN.findall(term)]
+        if not tokens:
+            raise Exception("Empty query.")
+        self.text = ' '.join(tokens)
+        if any(token in KEYWORDS for token in tokens):
+            self._selector = _Parser(tokens).parse()
+        else:
+            self._selector = _legacy(tokens)
+
+    def __str__(self) -> str:
+        return self.text
+
+    def bits(self, groups: GroupIndex) -> int:
+        "bitset of the matching hosts"
+        return self._selector(groups)
+
+    def select(self, groups: GroupIndex) -> List:
+        "the matching hosts, in order of the index"
+        return groups.members(self.bits(groups))
+
+
+def _term(token: str) -> Selector:
+    if token.startswith('!'):
+        return _negate(_term(token[1:]))
+    if not token:
+        raise Exception("Empty term in query.")
+    if '=' in token:
+        var, value = token.split('=', 1)
+        if not var:
+            raise Exception("Missing variable name in query term %s." % token)
+        return lambda groups: groups.matching(var, value)
+    return lambda groups: groups.bits(token) | groups.named(token)
+
+
+def _negate(selector: Selector) -> Selector:
+    return lambda groups: groups.all & ~selector(groups)
+
+
+def _combine(op, selectors: List[Selector]) -> Selector:
+    if len(selectors) == 1:
+        return selectors[0]
+    return lambda groups: functools.reduce(op, (selector(groups) for selector in selectors))
+
+
+def _legacy(tokens: List[str]) -> Selector:
+    "hosts matching any term and none of the terms starting with !"
+    include = [_term(token) for token in tokens if not token.startswith('!')]
+    exclude = [_term(token[1:]) for token in tokens if token.startswith('!')]
+
+    def select(groups: GroupIndex) -> int:
+        bits = 0
+        for selector in include:
+            bits |= selector(groups)
+        for selector in exclude:
+            bits &= ~selector(groups)
+        return bits
+    return select
+
+
+class _Parser:
+    "recursive descent parser of queries with keywords"
+
+    def __init__(self, tokens: List[str]) -> None:
+        self.tokens = tokens
+        self.pos = 0
+
+    def parse(self) -> Selector:
+        selector = self._or()
+        if self.pos < len(self.tokens):
+            raise Exception("Unexpected %s in query, missing AND or OR?" % self.tokens[self.pos])
+        return selector
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self) -> str:
+        token = self._peek()
+        if token is None:
+            raise Exception("Unexpected end of query.")
+        self.pos += 1
+        return token
+
+    def _or(self) -> Selector:
+        selectors = [self._and()]
+        while self._peek() == 'OR':
+            self.pos += 1
+            selectors.append(self._and())
+        return _combine(operator.or_, selectors)
+
+    def _and(self) -> Selector:
+        selectors = [self._not()]
+        while self._peek() == 'AND':
+            self.pos += 1
+            selectors.append(self._not())
+        return _combine(operator.and_, selectors)
+
+    def _not(self) -> Selector:
+        token = self._next()
+        if token == 'NOT':
+            return _negate(self._not())
+        if token == '(':
+            selector = self._or()
+            if self._next() != ')':
+                raise Exception("Missing ) in query.")
+            return selector
+        if token in KEYWORDS:
+            raise Exception("Unexpected %s in query." % token)
+        return _term(token)
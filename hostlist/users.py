@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import pwd
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from .cache import atomic_write, get_cachedir
+from .config import CompiledConfig
+
+
+class UserResolver:
+    """Tells which user accounts exist
+
+    All usernames are resolved in one pass over the passwd database
+    (including NSS sources that allow enumeration). Only names missing
+    there are looked up one by one, without forking. Results are kept for
+    ttl seconds, in memory and in cachefile if given.
+    """
+
+    def __init__(self, ttl: int=3600, cachefile: Optional[str]=None) -> None:
+        self.ttl = ttl
+        self.cachefile = cachefile
+        self._known = {}  # type: Dict[str, tuple]
+        self._lock = threading.Lock()
+        if cachefile:
+            try:
+                with open(cachefile) as infile:
+                    self._known = {name: tuple(entry) for name, entry in json.load(infile).items()}
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.debug("Ignoring broken user cache %s: %s" % (cachefile, e))
+
+    @staticmethod
+    def _lookup(name: str) -> bool:
+        try:
+            if name.isdigit():
+                # like id, accept uids
+                pwd.getpwuid(int(name))
+            else:
+                pwd.getpwnam(name)
+        except KeyError:
+            return False
+        return True
+
+    def resolve(self, names: Iterable) -> Dict[str, bool]:
+        "return for each of names whether the user exists"
+        names = {str(name) for name in names}
+        now = time.time()
+        with self._lock:
+            missing = {name for name in names
+                       if name not in self._known or now - self._known[name][1] > self.ttl}
+            if missing:
+                logging.debug("Resolving %s users" % len(missing))
+                existing = set()  # type: set
+                if len(missing) > 1:
+                    existing = {entry.pw_name for entry in pwd.getpwall()}
+                for name in missing:
+                    self._known[name] = (name in existing or self._lookup(name), now)
+                self._save(now)
+            return {name: self._known[name][0] for name in names}
+
+    def _save(self, now: float) -> None:
+        if not self.cachefile:
+            return
+        current = {name: entry for name, entry in self._known.items() if now - entry[1] <= self.ttl}
+        try:
+            atomic_write(self.cachefile, json.dumps(current).encode())
+        except OSError as e:
+            logging.warning("Failed to write user cache %s: %s" % (self.cachefile, e))
+
+
+_resolvers = {}  # type: Dict[tuple, UserResolver]
+
+
+def get_resolver(config: CompiledConfig) -> UserResolver:
+    "return the resolver for config, shared between runs in the same process"
+    ttl = config.get('user_cache_ttl', 3600)
+    cachedir = get_cachedir(config)
+    cachefile = os.path.join(cachedir, 'users.json') if cachedir else None
+    key = (ttl, cachefile)
+    if key not in _resolvers:
+        _resolvers[key] = UserResolver(ttl, cachefile)
+    return _resolvers[key]
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""module fixtures giving the tests of a module their own XDG_CACHE_HOME
+
+So the parse cache is not written below ~/.cache. Use them with
+from cachehome import setup_module, teardown_module"""
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+_state = {}
+
+
+def setup_module():
+    _state['dir'] = tempfile.mkdtemp()
+    _state['environ'] = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': _state['dir']})
+    _state['environ'].start()
+
+
+def teardown_module():
+    _state.pop('environ').stop()
+    shutil.rmtree(_state.pop('dir'))
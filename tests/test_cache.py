@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from hostlist import cache
+from hostlist import hostlist
+from hostlist.config import CONFIGINSTANCE as Config, CompiledConfig
+
+
+class TestCache():
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.dir})
+        self.environ.start()
+        self.hosts = hostlist.YMLHostlist()
+
+    def teardown(self):
+        self.environ.stop()
+        shutil.rmtree(self.dir)
+
+    def testcachedload(self):
+        with mock.patch.object(hostlist.yaml, 'load_all',
+                               side_effect=AssertionError("yaml parsed despite cache")):
+            cached = hostlist.YMLHostlist()
+        assert [str(h) for h in cached] == [str(h) for h in self.hosts]
+        assert cached.fileheaders == self.hosts.fileheaders
+
+    def testnocache(self):
+        uncached = hostlist.YMLHostlist(use_cache=False)
+        assert [str(h) for h in uncached] == [str(h) for h in self.hosts]
+
+
+class TestCacheDir():
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def testdefault(self):
+        config = Config.compiled()
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.dir}):
+            cachedir = cache.get_cachedir(config)
+        assert os.path.dirname(cachedir) == os.path.join(self.dir, 'hostlist')
+        assert os.path.basename(cachedir).startswith('hostlists-')
+        other = CompiledConfig(dict(Config, hostlistdir=self.dir))
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.dir}):
+            assert cache.get_cachedir(other) != cachedir
+        assert cache.get_cachedir(CompiledConfig(dict(Config, cache_dir=False))) is None
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import json
+import tempfile
+
+from hostlist import hostlist
+from hostlist import host
+from hostlist import cnamelist
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestChecks():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist()
+
+    def _add(self, **hostdata):
+        newhost = host.YMLHost(hostdata, 'desktops', 'abc')
+        self.hosts.append(newhost)
+        return newhost
+
+    def testconsistent(self):
+        assert self.hosts.check_duplicates()
+        assert self.hosts.check_nonunique()
+        assert self.hosts.check_missing_mac_ip()
+
+    def testduplicateip(self):
+        self._add(hostname='dup1', ip='198.51.100.3', mac='00:12:34:ab:00:01')
+        assert not self.hosts.check_duplicates()
+
+    def testduplicatemac(self):
+        self._add(hostname='dup1', ip='198.51.100.50', mac='00:12:34:AB:CD:EF')
+        assert not self.hosts.check_duplicates()
+
+    def testnonunique(self):
+        self._add(hostname='nu1', ip='198.51.100.10', unique=False)
+        self._add(hostname='nu2', ip='198.51.100.10', unique=False)
+        assert self.hosts.check_duplicates()
+        assert self.hosts.check_nonunique()
+        self._add(hostname='nu3', ip='198.51.100.10')
+        self._add(hostname='nu4', ip='198.51.100.10')
+        assert not self.hosts.check_nonunique()
+
+    def testnonuniqueflag(self):
+        self._add(hostname='nu1', ip='198.51.100.11', unique=False)
+        assert not self.hosts.check_nonunique()
+
+    def testcnames(self):
+        cnames = cnamelist.CNamelist([cnamelist.CName('www.abc.example.com', 'host3.abc.example.com')])
+        assert self.hosts.check_cnames(cnames)
+        cnames.append(cnamelist.CName('host4.abc.example.com', 'host3.abc.example.com'))
+        assert not self.hosts.check_cnames(cnames)
+        cnames = cnamelist.CNamelist([cnamelist.CName('www.abc.example.com', 'gone.abc.example.com')])
+        assert not self.hosts.check_cnames(cnames)
+
+    def testreport(self):
+        self._add(hostname='dup1', ip='198.51.100.3', mac='00:12:34:ab:00:01')
+        cnames = cnamelist.CNamelist([cnamelist.CName('www.abc.example.com', 'gone.abc.example.com')])
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as reportfile:
+            try:
+                self.hosts.check_consistency(cnames, report=reportfile.name)
+            except SystemExit as e:
+                assert e.code == 1
+            else:
+                assert False
+            report = json.load(reportfile)
+        assert not report['success']
+        assert not report['checks']['duplicates']['success']
+        assert not report['checks']['cnames']['success']
+        assert report['checks']['nonunique']['success']
+        assert report['checks']['duplicates']['failures'][0].startswith('Found duplicate ip')
+        assert report['checks']['duplicates']['hosts'] == len(self.hosts)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from hostlist.config import CONFIGINSTANCE as Config, CompiledConfig
+from hostlist.output_services import cmdb
+
+
+class TestFactCache():
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'host1')
+        with open(self.fname, 'w') as factfile:
+            json.dump({'ansible_memtotal_mb': 2048}, factfile)
+        with open(os.path.join(self.dir, 'broken'), 'w') as factfile:
+            factfile.write('not json')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def testreread(self):
+        assert cmdb._read_fact_dir(self.dir) == [('host1', {'ansible_memtotal_mb': 2048})]
+        cached = cmdb._read_fact_dir(self.dir)[0][1]
+        assert cmdb._read_fact_dir(self.dir)[0][1] is cached
+        with open(self.fname, 'w') as factfile:
+            json.dump({'ansible_memtotal_mb': 4096}, factfile)
+        stat = os.stat(self.fname)
+        os.utime(self.fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cmdb._read_fact_dir(self.dir) == [('host1', {'ansible_memtotal_mb': 4096})]
+
+    def testremoved(self):
+        assert cmdb._read_fact_dir(self.dir) == [('host1', {'ansible_memtotal_mb': 2048})]
+        os.unlink(self.fname)
+        assert cmdb._read_fact_dir(self.dir) == []
+        assert list(cmdb._facts[self.dir]) == ['broken']
+
+    def testinputsversion(self):
+        config = CompiledConfig(dict(Config, ansible_cmdb={'fact_dirs': [self.dir]}))
+        version = cmdb.inputs_version(config)
+        assert cmdb.inputs_version(config) == version
+        stat = os.stat(self.fname)
+        os.utime(self.fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cmdb.inputs_version(config) != version
+        version = cmdb.inputs_version(config)
+        os.unlink(self.fname)
+        assert cmdb.inputs_version(config) != version
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import ipaddress
+import pickle
+
+from hostlist.config import CONFIGINSTANCE as Config, load_compiled
+
+
+class TestCompiledConfig():
+    def setup(self):
+        Config.load()
+        self.config = Config.compiled()
+
+    def teardown(self):
+        Config.load()
+
+    def testvalues(self):
+        assert self.config.internal == ipaddress.ip_network('203.0.113.0/24')
+        assert '198.51.100.10' in self.config.nonunique_ips
+        assert self.config.ansiblevars == ('some_var', 'hosttype', 'institute', 'docker')
+        assert self.config['hostlistdir'] == 'hostlists/'
+
+    def testsnapshot(self):
+        assert Config.compiled() is self.config
+        Config.load()
+        reloaded = Config.compiled()
+        assert reloaded.version > self.config.version
+        assert reloaded.digest == self.config.digest
+
+    def testversion(self):
+        first, second = load_compiled(), load_compiled()
+        assert self.config.version < first.version < second.version
+        assert first.digest == second.digest
+
+    def testinvalidate(self):
+        Config.update({'domain': 'other.example.com'})
+        updated = Config.compiled()
+        assert updated is not self.config
+        assert updated.domain == 'other.example.com'
+        Config.pop('domain')
+        assert Config.compiled() is not updated
+        assert Config.compiled().domain is None
+
+    def testimmutable(self):
+        try:
+            self.config.domain = 'other.example.com'
+        except AttributeError:
+            pass
+        else:
+            assert False
+        copy = pickle.loads(pickle.dumps(self.config))
+        assert copy.digest == self.config.digest
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
+
+import cherrypy
+import git
+from cherrypy.lib import httputil
+
+from hostlist import daemon
+from hostlist import hostlist
+from hostlist.config import CONFIGINSTANCE as Config, CompiledConfig
+from hostlist.output_services import Output_Classes
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestChangedFiles():
+    def setup(self):
+        Config.compiled()
+        self.dir = tempfile.mkdtemp()
+        shutil.copytree('hostlists', os.path.join(self.dir, 'hostlists'))
+        self.repo = git.Repo.init(self.dir)
+        self.repo.index.add(['hostlists'])
+        self.first = self._commit('init')
+        # the cache of the temporary hostlistdir goes with it
+        self.config = CompiledConfig(dict(Config, hostlistdir=os.path.join(self.dir, 'hostlists/'),
+                                          cache_dir=os.path.join(self.dir, 'cache')))
+        self.inventory = daemon.Inventory.__new__(daemon.Inventory)
+        self.inventory.repo = self.repo
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _commit(self, message):
+        actor = git.Actor('test', 'test@example.com')
+        return self.repo.index.commit(message, author=actor, committer=actor).hexsha
+
+    def testrename(self):
+        hosts = hostlist.YMLHostlist(config=self.config)
+        self.repo.index.move(['hostlists/server.yml', 'hostlists/server-abc.yml'])
+        commit = self._commit('rename')
+        previous = types.SimpleNamespace(commit=self.first, config=self.config)
+        hostfiles, cnames_changed = self.inventory._changed_files(previous, commit)
+        assert sorted(os.path.basename(f) for f in hostfiles) == ['server-abc.yml', 'server.yml']
+        assert not cnames_changed
+        updated = hosts.updated(hostfiles)
+        assert len(updated) == len(hosts)
+        assert sorted(h.fqdn for h in updated) == sorted(h.fqdn for h in hosts)
+
+
+    def testconfigreload(self):
+        self.inventory.executor = _Executor()
+        settings = dict(Config, hostlistdir=self.config['hostlistdir'], cache_dir=self.config['cache_dir'])
+        same = CompiledConfig(settings)
+        edited = CompiledConfig(dict(settings, nonunique_ips=[]))
+        with mock.patch.object(daemon, 'load_compiled', side_effect=[self.config, same, edited]), \
+                mock.patch.object(daemon.Inventory, '_render', return_value=('"x"', {'identity': b'x'})):
+            first = self.inventory._build(None)
+            # an unchanged config is reused with the hosts parsed for it
+            second = self.inventory._build(first)
+            assert second.config is first.config
+            assert second.hostlist is first.hostlist
+            # a local edit of the config, not seen in the git diff
+            third = self.inventory._build(second)
+        assert third.config is edited
+        assert third.hostlist is not first.hostlist
+        assert third.generation != first.generation
+
+
+def _future(result=None, exception=None):
+    future = concurrent.futures.Future()
+    if exception is not None:
+        future.set_exception(exception)
+    elif result is not None:
+        future.set_result(result)
+    return future
+
+
+class _Executor():
+    "runs what is submitted right away"
+
+    def submit(self, fn, *args):
+        try:
+            return _future(fn(*args))
+        except Exception as e:
+            return _future(exception=e)
+
+
+class TestServe():
+    def setup(self):
+        config = Config.compiled()
+        self.inventory = daemon.Inventory.__new__(daemon.Inventory)
+        self.inventory._publish_lock = threading.Lock()
+        self.inventory._inputs_checked = {}
+        self.hosts = hostlist.YMLHostlist(config=config)
+        self.inventory.snapshot = daemon.Snapshot('abc', config, self.hosts, [], {}, False)
+        self.rendered = self.inventory.snapshot.rendered
+
+    def _request(self, headers):
+        request = cherrypy._cprequest.Request(httputil.Host('127.0.0.1', 80, ''),
+                                              httputil.Host('127.0.0.1', 1234, ''))
+        request.headers = httputil.HeaderMap(headers)
+        response = cherrypy._cprequest.Response()
+        cherrypy.serving.load(request, response)
+        return request, response
+
+    def _get(self, service, params={}, **headers):
+        "the body and response of a GET of service with the given parameters and request headers"
+        _, response = self._request(headers)
+        body = self.inventory.index(service, **params)
+        return body, response
+
+    def testetag(self):
+        self.rendered['hosts'] = _future(('"new"', {'identity': b'new content'}))
+        body, response = self._get('hosts')
+        assert body == b'new content'
+        assert response.headers['ETag'] == '"new"'
+        body, response = self._get('hosts', **{'If-None-Match': '"old", W/"new"'})
+        assert response.status == 304
+        assert body == b''
+        body, response = self._get('hosts', **{'If-None-Match': '"old"'})
+        assert body == b'new content'
+
+    def teststale(self):
+        self.inventory.snapshot.stale['cmdb'] = ('"old"', {'identity': b'old content'})
+        self.rendered['cmdb'] = _future()
+        body, response = self._get('cmdb')
+        assert body == b'old content'
+        assert response.headers['ETag'] == '"old"'
+        self.rendered['cmdb'] = _future(exception=Exception('failed'))
+        assert self._get('cmdb')[0] == b'old content'
+        self.rendered['cmdb'] = _future(('"new"', {'identity': b'new content'}))
+        assert self._get('cmdb')[0] == b'new content'
+
+    def testinputs(self):
+        self.inventory.executor = _Executor()
+        self.rendered['cmdb'] = _future(('"old"', {'identity': b'old content'}))
+        snapshot = self.inventory.snapshot
+        snapshot.inputs['cmdb'] = 'old facts'
+        snapshot.shards.get(('cmdb', 1), lambda: self.rendered['cmdb'])
+        snapshot.shards.get(('hosts', 1), _future)
+        with mock.patch.object(daemon.Inventory, '_render', return_value=('"new"', {'identity': b'new content'})), \
+                mock.patch.object(Output_Classes['cmdb'], 'inputs_version', return_value='old facts'):
+            refreshed = snapshot.refreshed(False)
+            self.inventory._render_changed_inputs(refreshed)
+            assert refreshed.rendered['cmdb'] is self.rendered['cmdb']
+            Output_Classes['cmdb'].inputs_version.return_value = 'new facts'
+            self.inventory._render_changed_inputs(refreshed)
+        assert refreshed.rendered['cmdb'].result()[0] == '"new"'
+        assert refreshed.inputs['cmdb'] == 'new facts'
+        assert refreshed.stale['cmdb'][0] == '"new"'
+        assert 'cmdb' not in snapshot.stale
+        assert snapshot.rendered['cmdb'].result()[0] == '"old"'
+        assert list(refreshed.shards) == [('hosts', 1)]
+
+    def testencoding(self):
+        choose = daemon._choose_encoding
+        variants = {'identity': b'', 'gzip': b'', 'br': b''}
+        with mock.patch.object(daemon, 'ENCODINGS', [('br', None), ('gzip', None)]):
+            assert choose('', variants) == 'identity'
+            assert choose('gzip, br', variants) == 'br'
+            assert choose('gzip, br;q=0.5', variants) == 'gzip'
+            assert choose('br;q=0, x-gzip', variants) == 'gzip'
+            assert choose('gzip;q=0.5, identity', variants) == 'identity'
+            assert choose('gzip;q=0.5, identity;q=0.5', variants) == 'gzip'
+            assert choose('*', variants) == 'br'
+            assert choose('*;q=0.1, br;q=0', variants) == 'gzip'
+            # compressed variants only exist for larger outputs
+            assert choose('gzip, br', {'identity': b''}) == 'identity'
+            assert choose('gzip;q=bad', variants) == 'identity'
+            # identity refused
+            assert choose('identity;q=0', variants) is None
+            assert choose('gzip, identity;q=0', variants) == 'gzip'
+            assert choose('*;q=0', variants) is None
+            assert choose('gzip, *;q=0', {'identity': b''}) is None
+
+    def testencodingetag(self):
+        content = b'x' * daemon.COMPRESS_MIN_SIZE
+        variants = {'identity': content, 'gzip': daemon._gzip(content)}
+        self.rendered['hosts'] = _future(('"abc"', variants))
+        body, response = self._get('hosts', **{'Accept-Encoding': 'gzip'})
+        assert gzip.decompress(body) == content
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'] == '"abc-gzip"'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        body, response = self._get('hosts', **{'Accept-Encoding': 'gzip', 'If-None-Match': '"abc-gzip"'})
+        assert response.status == 304
+        # the ETag of another encoding does not match
+        body, response = self._get('hosts', **{'Accept-Encoding': 'identity', 'If-None-Match': '"abc-gzip"'})
+        assert body == content
+        assert response.headers['ETag'] == '"abc"'
+        assert 'Content-Encoding' not in response.headers
+        # compressed without a timestamp, so every render has the same ETag and bytes
+        assert daemon._gzip(content) == variants['gzip']
+        try:
+            self._get('hosts', **{'Accept-Encoding': 'br, identity;q=0'})
+        except cherrypy.HTTPError as e:
+            assert e.status == 406
+        else:
+            raise AssertionError("refused encoding sent")
+
+    def testvary(self):
+        self.rendered['hosts'] = _future(exception=Exception('failed'))
+        body, response = self._get('hosts')
+        assert b''.join(chunk.encode() for chunk in body)
+        assert response.headers['Vary'] == 'Accept-Encoding'
+
+    def testserveinputs(self):
+        self.inventory.executor = _Executor()
+        snapshot = self.inventory.snapshot
+        self.rendered['cmdb'] = _future(('"old"', {'identity': b'old content'}))
+        snapshot.inputs['cmdb'] = 'old facts'
+        with mock.patch.object(daemon.Inventory, '_render', return_value=('"new"', {'identity': b'new content'})), \
+                mock.patch.object(Output_Classes['cmdb'], 'inputs_version', return_value='old facts'), \
+                mock.patch.object(self.inventory, 'request_refresh', side_effect=AssertionError("pulled")):
+            assert self._get('cmdb')[0] == b'old content'
+            Output_Classes['cmdb'].inputs_version.return_value = 'new facts'
+            # checked at most every inputs_interval seconds
+            assert self._get('cmdb')[0] == b'old content'
+            assert Output_Classes['cmdb'].inputs_version.call_count == 1
+            self.inventory._inputs_checked['cmdb'] -= self.inventory.inputs_interval
+            assert self._get('cmdb')[0] == b'new content'
+        assert self.inventory.snapshot is not snapshot
+        assert self.inventory.snapshot.inputs['cmdb'] == 'new facts'
+        assert snapshot.rendered['cmdb'].result()[0] == '"old"'
+
+    def testlaterender(self):
+        old = self.inventory.snapshot
+        late = _future()
+        old.rendered['cmdb'] = late
+        old.keep_stale('cmdb', late)
+        new = daemon.Snapshot('def', old.config, self.hosts, [], {}, False, old)
+        new.rendered['cmdb'] = _future()
+        new.keep_stale('cmdb', new.rendered['cmdb'])
+        new.rendered['cmdb'].set_result(('"new"', {'identity': b'new content'}))
+        late.set_result(('"old"', {'identity': b'old content'}))
+        assert new.stale['cmdb'][0] == '"new"'
+        assert old.stale['cmdb'][0] == '"old"'
+        # a replaced render of the same snapshot
+        refreshed = new.refreshed(False)
+        replaced = refreshed.rendered['cmdb'] = _future()
+        refreshed.keep_stale('cmdb', replaced)
+        replaced.set_result(('"newer"', {'identity': b'newer content'}))
+        assert refreshed.stale['cmdb'][0] == '"newer"'
+
+    def testdispatch(self):
+        request, _ = self._request({})
+        request.params = {'group': 'desktops'}
+        vpath = ['hosts', 'group', 'server', 'subnet', '198.51.100.0', '24', 'institute', 'abc']
+        assert self.inventory._cp_dispatch(vpath) is self.inventory
+        assert vpath == []
+        assert request.params == {'service': 'hosts', 'group': ['desktops', 'server'],
+                                  'subnet': ['198.51.100.0/24'], 'institute': ['abc']}
+        request.params = {}
+        vpath = ['hosts', 'group']
+        self.inventory._cp_dispatch(vpath)
+        assert vpath == ['group']
+        assert request.params == {'service': 'hosts'}
+
+    def _fqdns(self, params):
+        self.inventory.executor = _Executor()
+        self.rendered['hosts'] = _future(daemon.Inventory._render('hosts', self.hosts, []))
+        body = self._get('hosts', params)[0].decode()
+        return sorted(h.fqdn for h in self.hosts if h.fqdn in body)
+
+    def testshards(self):
+        assert daemon._values(None) == ()
+        assert daemon._values('b') == ('b',)
+        assert daemon._values(['b', 'a', 'b']) == ('a', 'b')
+        servers = ['serv1.abc.example.com', 'serv2.abc.example.com']
+        assert self._fqdns({'group': 'server'}) == servers
+        # several values of one parameter, any of them
+        assert self._fqdns({'group': ['server', 'superserver']}) == servers
+        both = self._fqdns({'group': ['server', 'desktops']})
+        assert set(servers) < set(both)
+        # different parameters, all of them
+        assert self._fqdns({'group': ['server', 'desktops'], 'subnet': '198.51.100.0/30'}) == \
+            self._fqdns({'subnet': '198.51.100.0/30', 'q': 'server OR desktops'})
+        assert self._fqdns({'group': 'server', 'q': 'superserver'}) == ['serv1.abc.example.com']
+
+    def testshardcache(self):
+        self.inventory.executor = _Executor()
+        self._get('hosts', {'group': 'server'})
+        self._get('hosts', {'q': 'server'})
+        self._get('hosts', {'group': 'server', 'subnet': '0.0.0.0/0'})
+        assert len(list(self.inventory.snapshot.shards)) == 1
+        # all hosts are the unsharded output
+        self.rendered['hosts'] = _future(('"all"', {'identity': b'all hosts'}))
+        assert self._get('hosts', {'subnet': '0.0.0.0/0'})[0] == b'all hosts'
+        assert len(list(self.inventory.snapshot.shards)) == 1
+
+    def testshardbytes(self):
+        cache = daemon.ShardCache()
+        cache.max_bytes = 10
+        for key in range(4):
+            cache.get(key, lambda: _future(('"%s"' % key, {'identity': b'1234', 'gzip': b'5'})))
+        assert list(cache) == [2, 3]
+        assert cache.size == 10
+        cache.get(4, lambda: _future(exception=Exception('failed')))
+        assert list(cache) == [2, 3]
+
+    def testfailedshard(self):
+        self.inventory.executor = _Executor()
+        with mock.patch.object(daemon.Inventory, '_render', side_effect=Exception('failed')):
+            body, response = self._get('hosts', {'group': 'server'})
+        body = ''.join(body)
+        assert 'serv1.abc.example.com' in body and 'host3.abc.example.com' not in body
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert list(self.inventory.snapshot.shards) == []
+
+    def testbadshard(self):
+        for params in ({'subnet': 'not-a-net'}, {'q': 'server AND'}, {'q': 'a=b=c OR ('}):
+            try:
+                self._get('hosts', params)
+            except cherrypy.HTTPError as e:
+                assert e.status == 400
+            else:
+                raise AssertionError("invalid shard %s served" % params)
+
+
+class TestRefresh():
+    def setup(self):
+        self.inventory = daemon.Inventory.__new__(daemon.Inventory)
+        self.inventory.refresh_delay = 0.1
+        self.inventory.refresh_interval = 0
+        self.inventory._last_refresh = time.monotonic()
+        self.inventory._refresh_requested = threading.Event()
+        self.inventory._publish_lock = threading.Lock()
+        self.snapshot = daemon.Snapshot('abc', Config.compiled(), [], [], {}, False)
+        self.inventory.snapshot = self.snapshot
+        self.builds = []
+
+    def _build(self, previous):
+        self.builds.append(previous)
+        time.sleep(0.1)
+        return previous.refreshed(False)
+
+    def testconcurrent(self):
+        with mock.patch.object(self.inventory, '_build', side_effect=self._build):
+            threading.Thread(target=self.inventory._refresh_loop, daemon=True).start()
+            requests = [threading.Thread(target=self.inventory.request_refresh) for _ in range(10)]
+            for thread in requests:
+                thread.start()
+            for thread in requests:
+                thread.join()
+            deadline = time.monotonic() + 5
+            while self.inventory.snapshot is self.snapshot and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.3)
+        assert self.builds == [self.snapshot]
+        assert self.inventory.snapshot is not self.snapshot
+
+    def testfailed(self):
+        self.snapshot.rendered['hosts'] = _future(('"old"', {'identity': b'old content'}))
+        with mock.patch.object(self.inventory, '_build', side_effect=Exception('pull failed')):
+            assert not self.inventory.refresh()
+        snapshot = self.inventory.snapshot
+        assert snapshot.refresh_failed
+        assert snapshot.generation == self.snapshot.generation
+        assert snapshot.rendered is self.snapshot.rendered
+        assert not self.snapshot.refresh_failed
+        with mock.patch.object(self.inventory, '_build', side_effect=self._build):
+            assert self.inventory.refresh()
+        assert not self.inventory.snapshot.refresh_failed
@@ -2,9 +2,14 @@
 
 from hostlist import hostlist
 from hostlist import cnamelist
+from hostlist.groupindex import GroupIndex
 from hostlist.output_services import Output_Services
 from pprint import pprint
+import ipaddress
 import json
+from unittest import mock
+
+from cachehome import setup_module, teardown_module  # noqa: F401
 
 
 class TestGroup():
@@ -35,3 +40,69 @@ class TestGroup():
         assert data['superserver']['hosts'] == ['serv1.abc.example.com']
         assert data['serverheadergroup']['hosts'] == ['serv1.abc.example.com', 'serv2.abc.example.com']
         assert data['blubberinst']['hosts'] == ['serv1.abc.example.com']
+
+    def testgroupindex(self):
+        servers = self.hosts.groups['server']
+        assert [h.fqdn for h in servers] == ['serv1.abc.example.com', 'serv2.abc.example.com']
+        selected = self.hosts.groups.members(self.hosts.groups.select(['server'], ['superserver']))
+        assert [h.fqdn for h in selected] == ['serv2.abc.example.com']
+        self.hosts.remove(servers[0])
+        assert 'superserver' not in self.hosts.groups
+        assert self.hosts.groups['superserver'] == []
+        self.hosts.append(servers[0])
+        assert self.hosts.groups['server'] == [servers[1], servers[0]]
+
+    def testnetwork(self):
+        groups = self.hosts.groups
+        selected = groups.members(groups.in_network(ipaddress.ip_network('198.51.100.0/30')))
+        assert [h.fqdn for h in selected] == ['host3.abc.example.com']
+        selected = groups.members(groups.in_network(ipaddress.ip_network('198.51.100.64/26')))
+        assert [h.fqdn for h in selected] == ['serv1.abc.example.com', 'serv3.abc.example.com']
+        assert groups.in_network(ipaddress.ip_network('2001:db8::/32')) == 0
+        self.hosts.remove(selected[0])
+        selected = groups.members(groups.in_network(ipaddress.ip_network('198.51.100.64/26')))
+        assert [h.fqdn for h in selected] == ['serv3.abc.example.com']
+
+    def testduplicate(self):
+        try:
+            self.hosts.append(self.hosts[0])
+        except Exception:
+            pass
+        else:
+            raise AssertionError("host appended twice")
+        assert self.hosts.count(self.hosts[0]) == 1
+
+    def testcompact(self):
+        hosts = list(self.hosts)
+        groups = GroupIndex()
+        groups.compact_min = 4
+        for h in hosts:
+            groups.add(h)
+        for h in hosts:
+            groups.remove(h)
+        assert groups.hosts == []
+        for h in hosts:
+            groups.add(h)
+        for h in hosts[1:-1]:
+            groups.remove(h)
+        assert len(groups.hosts) == 2
+        assert groups.members(groups.all) == [hosts[0], hosts[-1]]
+        assert groups.members(groups.in_network(ipaddress.ip_network('198.51.100.0/24'))) == [hosts[0], hosts[-1]]
+
+    def testmatchingwhilebuilding(self):
+        "a lookup while the value index is built sees all hosts"
+        groups = self.hosts.groups
+        seen = []
+
+        class Vars(dict):
+            def __contains__(self, var):
+                if not seen:
+                    seen.append(None)
+                    seen[0] = groups.matching('institute', 'abc')
+                return dict.__contains__(self, var)
+
+        first = self.hosts[0]
+        with mock.patch.object(first, 'vars', Vars(first.vars)):
+            expected = groups.matching('institute', 'abc')
+        assert expected
+        assert seen == [expected]
@@ -3,6 +3,8 @@
 from hostlist import hostlist
 from hostlist import cnamelist
 
+from cachehome import setup_module, teardown_module  # noqa: F401
+
 
 class TestGroup():
     def setup(self):
@@ -12,3 +14,18 @@ class TestGroup():
     def testgroups(self):
         serv3 = list(filter(lambda x: x.fqdn == 'serv3.abc.example.com', self.hosts))[0]
         assert serv3 in self.hosts.groups['newservertype']
+
+    def testsharedvars(self):
+        host3 = list(filter(lambda x: x.fqdn == 'host3.abc.example.com', self.hosts))[0]
+        host4 = list(filter(lambda x: x.fqdn == 'host4.abc.example.com', self.hosts))[0]
+        assert host3.vars['some_var'] == 'default value'
+        assert host3.vars['hosttype'] == 'desktops'
+        assert 'some_var' not in host3.vars.own
+        assert host3.vars.shared is host4.vars.shared
+        host3.vars['some_var'] = 'changed'
+        assert host4.vars['some_var'] == 'default value'
+
+    def testheaderoverride(self):
+        serv3 = list(filter(lambda x: x.fqdn == 'serv3.abc.example.com', self.hosts))[0]
+        assert serv3.vars['hosttype'] == 'newservertype'
+        assert serv3.vars['unique']
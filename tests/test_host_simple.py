@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 from hostlist import host
+import gc
 import ipaddress
+import pickle
 
 
 class TestSimpleHost():
@@ -20,3 +22,37 @@ class TestSimpleHost():
         assert self.host.mac == host.MAC('00:12:34:ab:cd:ef')
         assert self.host.ip == ipaddress.ip_address('198.51.100.2')
         assert self.host.aliases == ['host1.abc.example.com', 'host1']
+
+    def testCompact(self):
+        other = host.YMLHost(
+            {
+                'hostname': 'host2.abc.example.com',
+                'ip': '198.51.100.3',
+            },
+            "desktops",
+            "abc",
+        )
+        assert not hasattr(self.host, '__dict__')
+        assert self.host.groups is other.groups
+        assert self.host.aliases is self.host.aliases
+
+    def testPickle(self):
+        copy = pickle.loads(pickle.dumps(self.host))
+        assert copy.groups is self.host.groups
+        assert str(copy) == str(self.host)
+
+    def testInternedGroupsReleased(self):
+        groups = host.intern_groups(['only-this-test'])
+        assert host.intern_groups({'only-this-test'}) is groups
+        del groups
+        gc.collect()
+        assert frozenset(['only-this-test']) not in host._GROUPSETS
+
+    def testSectionLayer(self):
+        layer = host.section_layer({'iprange': None}, "desktops", "abc")
+        hosts = [host.YMLHost({'hostname': 'host%d.abc.example.com' % i, 'ip': '198.51.100.%d' % i},
+                              "desktops", "abc", layer=layer)
+                 for i in (4, 5)]
+        assert all(h.vars.shared is layer for h in hosts)
+        assert hosts[0].vars['hosttype'] == 'desktops'
+        assert self.host.vars.shared is not layer
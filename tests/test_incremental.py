@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from hostlist import buildfiles
+from hostlist import hostlist
+from hostlist import cnamelist
+from hostlist.config import CONFIGINSTANCE as Config, CompiledConfig
+
+NEWHOSTS = '''
+  - hostname: host6.abc.example.com
+    mac: 00:12:34:ab:CD:F6
+    ip: 198.51.100.100
+  - hostname: serv2
+    mac: 00:12:34:ab:CD:F7
+    ip: 198.51.100.7
+'''
+
+
+class TestIncremental():
+    def setup(self):
+        Config.compiled()
+        self.dir = tempfile.mkdtemp()
+        shutil.copytree('hostlists', os.path.join(self.dir, 'hostlists'))
+        self.config = CompiledConfig(dict(Config,
+                                          hostlistdir=os.path.join(self.dir, 'hostlists/'),
+                                          cache_dir=os.path.join(self.dir, 'cache')))
+        self.cnames = cnamelist.FileCNamelist(self.config)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _check(self, fnames=None, **kwargs):
+        hosts = hostlist.YMLHostlist(config=self.config, fnames=fnames)
+        reportname = os.path.join(self.dir, 'report.json')
+        try:
+            if fnames is None:
+                hosts.check_consistency(self.cnames, report=reportname, **kwargs)
+            else:
+                hosts.check_changes(self.cnames, report=reportname, **kwargs)
+        except SystemExit:
+            pass
+        with open(reportname) as reportfile:
+            return json.load(reportfile)
+
+    def testunchanged(self):
+        assert self._check(incremental=True)['success']
+        assert os.path.exists(os.path.join(self.dir, 'cache', 'checkstate.pickle'))
+        report = self._check(incremental=True)
+        assert report['success']
+        assert report['checks']['duplicates']['hosts'] == 0
+        assert report['checks']['end_date']['hosts'] == 6
+
+    def testchanged(self):
+        self._check(incremental=True)
+        with open(os.path.join(self.dir, 'hostlists', 'desktops-abc.yml'), 'a') as hostfile:
+            hostfile.write(NEWHOSTS)
+        incremental = self._check(incremental=True)
+        assert incremental['checks']['duplicates']['hosts'] == 5
+        assert not incremental['checks']['duplicates']['success']
+        full = self._check()
+        for name, result in full['checks'].items():
+            assert incremental['checks'][name]['success'] == result['success']
+            assert incremental['checks'][name]['failures'] == result['failures']
+        # the failed run must not replace the saved state
+        assert self._check(incremental=True)['checks']['duplicates']['hosts'] == 5
+
+    def testremoved(self):
+        self.cnames = cnamelist.CNamelist([cnamelist.CName('www.abc.example.com', 'serv2.abc.example.com')])
+        assert self._check(incremental=True)['success']
+        os.unlink(os.path.join(self.dir, 'hostlists', 'server.yml'))
+        report = self._check(incremental=True)
+        assert not report['checks']['cnames']['success']
+        assert report['checks']['cnames']['failures'] == self._check(full=True)['checks']['cnames']['failures']
+
+    def testchanges(self):
+        self._check(incremental=True)
+        fname = os.path.join(self.dir, 'hostlists', 'desktops-abc.yml')
+        with open(fname, 'a') as hostfile:
+            hostfile.write(NEWHOSTS)
+        changes = self._check([fname])
+        assert changes['checks']['end_date']['hosts'] == 5
+        full = self._check()
+        for name, result in full['checks'].items():
+            assert changes['checks'][name]['failures'] == result['failures']
+
+    def testchangeswithoutstate(self):
+        fname = os.path.join(self.dir, 'hostlists', 'server.yml')
+        os.unlink(fname)
+        assert self._check([], removed=[fname])['success']
+        assert not os.path.exists(os.path.join(self.dir, 'cache', 'checkstate.pickle'))
+
+
+class TestGitChanges():
+    def setup(self):
+        Config.compiled()
+        self.dir = tempfile.mkdtemp()
+        self.hostlistdir = os.path.join(self.dir, 'hostlists')
+        shutil.copytree('hostlists', self.hostlistdir)
+        self.config = CompiledConfig(dict(Config,
+                                          hostlistdir=self.hostlistdir + '/',
+                                          cache_dir=os.path.join(self.dir, 'cache')))
+        self._git('init', '-q')
+        self._git('add', '.')
+        self._git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-qm', 'init')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _git(self, *args):
+        subprocess.run(('git', '-C', self.hostlistdir) + args, check=True)
+
+    def _check(self, staged=True):
+        reportname = os.path.join(self.dir, 'report.json')
+        args = argparse.Namespace(changed_since=None if staged else 'HEAD', staged=staged,
+                                  jobs=1, no_cache=True, check_report=reportname)
+        try:
+            buildfiles.check_changes(args, self.config)
+        except SystemExit:
+            pass
+        with open(reportname) as reportfile:
+            return json.load(reportfile)
+
+    def testrename(self):
+        self._git('mv', 'server.yml', 'server-abc.yml')
+        assert buildfiles.changed_files(self.hostlistdir, staged=True) == ['server-abc.yml', 'server.yml']
+        assert buildfiles.changed_files(self.hostlistdir, 'HEAD') == ['server-abc.yml', 'server.yml']
+        assert self._check()['success']
+        assert self._check(staged=False)['success']
+
+    def teststaged(self):
+        fname = os.path.join(self.hostlistdir, 'desktops-abc.yml')
+        with open(fname) as hostfile:
+            committed = hostfile.read()
+        with open(fname, 'a') as hostfile:
+            hostfile.write(NEWHOSTS)
+        # the staged content counts, not the one in the working tree
+        assert self._check()['success']
+        assert not self._check(staged=False)['success']
+        self._git('add', 'desktops-abc.yml')
+        with open(fname, 'w') as hostfile:
+            hostfile.write(committed)
+        assert not self._check()['checks']['duplicates']['success']
+        assert self._check(staged=False)['success']
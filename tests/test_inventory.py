@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from hostlist import cnamelist
+from hostlist import hostlist
+from hostlist import inventory
+from hostlist.config import CONFIGINSTANCE as Config
+from hostlist.output_services import Output_Services
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestInventory():
+    def setup(self):
+        self.config = Config.compiled()
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def testcache(self):
+        cache = inventory.InventoryCache(self.dir, inventory.state_key(self.config))
+        assert not cache.complete
+        cache.build(inventory.render(self.config))
+        assert cache.complete
+        expected = json.loads(Output_Services['ansible'](hostlist.YMLHostlist(), cnamelist.CNamelist()))
+        assert json.loads(cache.list().decode()) == expected
+        assert json.loads(cache.host('host4.abc.example.com').decode()) == expected['_meta']['hostvars']['host4.abc.example.com']
+        assert cache.host('unknown.example.com') == b'{}'
+
+    def testkey(self):
+        key = inventory.state_key(self.config)
+        assert inventory.state_key(self.config) == key
+        fname = os.path.join(self.config.hostlistdir, 'server.yml')
+        stat = os.stat(fname)
+        os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        try:
+            assert inventory.state_key(self.config) != key
+        finally:
+            os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def testdumps(self):
+        data = {'end_date': datetime.date(2020, 1, 2), 'start': datetime.datetime(2020, 1, 2, 3, 4)}
+        # like the ansible output
+        expected = json.loads(json.dumps(data, default=str))
+        assert json.loads(inventory.dumps(data).decode()) == expected
+        with mock.patch.object(inventory, 'orjson', None):
+            assert json.loads(inventory.dumps(data).decode()) == expected
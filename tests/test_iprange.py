@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import ipaddress
+
+from hostlist import hostlist
+
+
+def iprange(low, high):
+    return ipaddress.ip_address(low), ipaddress.ip_address(high)
+
+
+class TestIprangeOverlap():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist(use_cache=False)
+        self.headers = {name: header for name, header, _ in self.hosts.sections()}
+
+    def testnames(self):
+        assert sorted(self.headers) == ['desktops-abc.yml', 'server.yml (document 1)', 'server.yml (document 2)']
+
+    def testnooverlap(self):
+        self.headers['desktops-abc.yml']['iprange'] = iprange('198.51.100.1', '198.51.100.50')
+        self.headers['server.yml (document 1)']['iprange'] = iprange('198.51.100.51', '198.51.100.100')
+        assert self.hosts.check_iprange_overlap()
+
+    def testoverlap(self):
+        self.headers['desktops-abc.yml']['iprange'] = iprange('198.51.100.1', '198.51.100.50')
+        self.headers['server.yml (document 1)']['iprange'] = iprange('198.51.100.40', '198.51.100.120')
+        assert not self.hosts.check_iprange_overlap()
+
+    def testdocuments(self):
+        self.headers['server.yml (document 1)']['iprange'] = iprange('198.51.100.100', '198.51.100.105')
+        self.headers['server.yml (document 2)']['iprange'] = iprange('198.51.100.101', '198.51.100.110')
+        assert not self.hosts.check_iprange_overlap()
+
+    def testallowoverlap(self):
+        self.headers['desktops-abc.yml']['iprange'] = iprange('198.51.100.1', '198.51.100.50')
+        self.headers['server.yml (document 1)']['iprange'] = iprange('198.51.100.40', '198.51.100.120')
+        self.headers['server.yml (document 1)']['iprange_allow_overlap'] = True
+        assert self.hosts.check_iprange_overlap()
+        # serv1 uses 198.51.100.100
+        self.headers['desktops-abc.yml']['iprange'] = iprange('198.51.100.1', '198.51.100.100')
+        assert not self.hosts.check_iprange_overlap()
+
+    def testfindoverlaps(self):
+        ranges = [(1, 5, 'a'), (10, 20, 'b'), (3, 12, 'c'), (21, 30, 'd'), (15, 16, 'e')]
+        assert sorted(hostlist.find_overlaps(ranges)) == [
+            (3, 5, 'a', 'c'), (10, 12, 'c', 'b'), (15, 16, 'b', 'e')]
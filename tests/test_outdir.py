@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from hostlist import hostlist
+from hostlist import cnamelist
+from hostlist import host
+from hostlist.buildfiles import write_service
+from hostlist.output_services import Output_Services
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestOutdir():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist()
+        self.cnames = cnamelist.FileCNamelist()
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def testwrite(self):
+        fname = os.path.join(self.dir, 'hosts')
+        assert write_service('hosts', self.hosts, self.cnames, self.dir)
+        with open(fname) as outfile:
+            assert outfile.read() == Output_Services['hosts'](self.hosts, self.cnames) + '\n'
+        os.utime(fname, (0, 0))
+        assert write_service('hosts', self.hosts, self.cnames, self.dir)
+        assert os.stat(fname).st_mtime == 0
+        self.hosts.pop()
+        assert write_service('hosts', self.hosts, self.cnames, self.dir)
+        assert os.stat(fname).st_mtime != 0
+
+    def testdelta(self):
+        fname = os.path.join(self.dir, 'dhcp')
+        assert write_service('dhcp', self.hosts, self.cnames, self.dir, delta=True)
+        with open(fname + '.delta') as deltafile:
+            delta = json.load(deltafile)
+        assert delta['from'] is None
+        assert len(delta['added']) == len([h for h in self.hosts if h.mac and h.ip])
+        with open(fname) as outfile:
+            assert outfile.read() == Output_Services['dhcp'](self.hosts, self.cnames) + '\n'
+        removed = [h for h in self.hosts if h.fqdn == 'serv2.abc.example.com'][0]
+        self.hosts.remove(removed)
+        changed = self.hosts[0]
+        changed.mac = host.MAC('00:12:34:ab:cd:aa')
+        assert write_service('dhcp', self.hosts, self.cnames, self.dir, delta=True)
+        with open(fname + '.delta') as deltafile:
+            second = json.load(deltafile)
+        assert second['from'] == delta['to'] != second['to']
+        assert second['added'] == {}
+        assert list(second['changed']) == [changed.fqdn]
+        assert '00:12:34:ab:cd:aa' in second['changed'][changed.fqdn]
+        assert second['removed'] == [removed.fqdn]
+        assert write_service('ansible', self.hosts, self.cnames, self.dir, delta=True)
+        assert not os.path.exists(os.path.join(self.dir, 'ansible.manifest'))
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+from unittest import mock
+
+from hostlist import hostlist
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestParallel():
+    def setup(self):
+        self.serial = hostlist.YMLHostlist(jobs=1)
+        self.parallel = hostlist.YMLHostlist(jobs=2)
+
+    def testorder(self):
+        assert [h.fqdn for h in self.parallel] == [h.fqdn for h in self.serial]
+        assert list(self.parallel.fileheaders) == list(self.serial.fileheaders)
+
+    def testgroups(self):
+        assert sorted(self.parallel.groups) == sorted(self.serial.groups)
+        for group, members in self.serial.groups.items():
+            assert [h.fqdn for h in self.parallel.groups[group]] == [h.fqdn for h in members]
+
+    def testforkserver(self):
+        "workers are not forked from a caller that may have other threads"
+        with mock.patch.object(hostlist.multiprocessing, 'get_context', wraps=multiprocessing.get_context) as context:
+            hosts = hostlist.YMLHostlist(jobs=2, use_cache=False)
+        context.assert_called_once_with('forkserver')
+        assert [h.fqdn for h in hosts] == [h.fqdn for h in self.serial]
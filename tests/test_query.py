@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from hostlist import hostlist
+from hostlist.query import Query
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestQuery():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist()
+
+    def _select(self, query):
+        return [h.fqdn.split('.')[0] for h in Query(query).select(self.hosts.groups)]
+
+    def testlegacy(self):
+        assert self._select(['desktops', '!headergroup']) == ['host4']
+        assert self._select(['server', 'host3.abc.example.com']) == ['host3', 'serv1', 'serv2']
+        assert self._select(['!server']) == []
+        legacy = [h for h in self.hosts if h.filter(['abc', 'ansible', '!desktops'])]
+        assert Query(['abc', 'ansible', '!desktops']).select(self.hosts.groups) == legacy
+
+    def testoperators(self):
+        assert self._select('abc AND NOT desktops') == ['serv3']
+        assert self._select('NOT abc') == ['serv1', 'serv2']
+        assert self._select('ansible AND (superserver OR desktops)') == ['host4', 'serv1']
+        assert self._select('server OR abc AND headergroup') == ['host3', 'host5', 'serv1', 'serv2']
+        assert self._select(['ansible', 'AND', '!server']) == ['host4']
+
+    def testvars(self):
+        assert self._select('institute=extinst OR serv3') == ['serv2', 'serv3']
+        assert self._select('server AND NOT institute=extinst') == ['serv1']
+        self.hosts.remove(self.hosts.groups['server'][0])
+        assert self._select('institute=blubberinst') == []
+
+    def testinvalid(self):
+        for query in ('', 'abc AND', 'abc desktops OR server', '(abc', 'NOT', '=abc', ['abc', '!']):
+            try:
+                Query(query)
+            except Exception:
+                continue
+            assert False, query
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from unittest import mock
+
+from hostlist import hostlist
+from hostlist import cnamelist
+from hostlist.output_services import Output, Output_Services, Output_Classes
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestStream():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist()
+        self.cnames = cnamelist.FileCNamelist()
+
+    def testhosts(self):
+        assert [str(h) for h in hostlist.iter_hosts()] == [str(h) for h in self.hosts]
+
+    def testoutputs(self):
+        for service in ('hosts', 'dhcp', 'ethers'):
+            streamed = Output_Services[service](hostlist.iter_hosts(), self.cnames)
+            assert streamed == Output_Services[service](self.hosts, self.cnames)
+
+    def testchunks(self):
+        for service in ('hosts', 'dhcp', 'ethers', 'munin', 'ssh_known_hosts', 'ansible'):
+            content = Output_Services[service](self.hosts, self.cnames)
+            with mock.patch.object(Output_Classes[service], 'chunksize', 1):
+                chunks = list(Output_Classes[service].iter_content(self.hosts, self.cnames))
+            assert ''.join(chunks) == content
+            # the test hostlist has only one munin node and no ssh_known_hosts
+            assert service in ('munin', 'ssh_known_hosts') or len(chunks) > 1
+
+    def testnocontent(self):
+        for attrs in ({}, {'has_entries': True}):
+            try:
+                type('nocontent', (Output,), attrs)
+            except Exception as e:
+                assert 'nocontent' in str(e)
+            else:
+                raise AssertionError("service without content accepted")
+        assert 'nocontent' not in Output_Classes
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+from hostlist import hostlist
+
+from cachehome import setup_module, teardown_module  # noqa: F401
+
+
+class TestUpdate():
+    def setup(self):
+        self.hosts = hostlist.YMLHostlist()
+
+    def testreparse(self):
+        updated = self.hosts.updated(['hostlists/server.yml'])
+        assert updated is not self.hosts
+        assert [str(h) for h in updated] == [str(h) for h in self.hosts]
+        assert sorted(updated.groups) == sorted(self.hosts.groups)
+        assert updated.fileheaders == self.hosts.fileheaders
+
+    def testremove(self):
+        updated = self.hosts.updated(['removed/server.yml'])
+        assert [h.fqdn for h in updated] == ['host3.abc.example.com', 'host4.abc.example.com', 'host5.abc.example.com']
+        assert 'server.yml' not in updated.fileheaders
+        assert 'superserver' not in updated.groups
+        assert len(self.hosts) == 6
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from hostlist import users
+
+
+class TestUsers():
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tmpdir, 'users.json')
+        self.resolver = users.UserResolver(cachefile=self.cachefile)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testresolve(self):
+        result = self.resolver.resolve(['root', 'no-such-user-hostlist', 0])
+        assert result == {'root': True, 'no-such-user-hostlist': False, '0': True}
+
+    def testpersistent(self):
+        self.resolver.resolve(['root', 'no-such-user-hostlist'])
+        reloaded = users.UserResolver(cachefile=self.cachefile)
+        with mock.patch.object(users.pwd, 'getpwall') as getpwall, \
+                mock.patch.object(users.pwd, 'getpwnam') as getpwnam:
+            assert reloaded.resolve(['root', 'no-such-user-hostlist']) == {'root': True, 'no-such-user-hostlist': False}
+        assert not getpwall.called and not getpwnam.called